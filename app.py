@@ -3,10 +3,60 @@ Aplicação Flask para Contratos Públicos Portugal 2024.
 Define as rotas e handlers da aplicação web.
 """
 
-from flask import Flask, render_template, request, abort
+from flask import Flask, Response, render_template, request, abort, jsonify, stream_with_context, url_for
+import datetime
+import json
+
+import autocomplete
+import benchmarks
+import cube
 import db
+import jobs
+import profiling
+import similarity
+import timeseries
 
 app = Flask(__name__)
+profiling.init_profiling(app)
+
+# Número de fragmentos do template agrupados em cada bloco enviado ao cliente
+STREAM_BUFFER_SIZE = 200
+
+# Limite máximo de registos nas listagens genéricas (?limit=)
+MAX_LIST_LIMIT = 50000
+
+# Colunas que formam o URL de detalhe das tabelas com chave composta
+COMPOSITE_KEYS = {
+    'CONTRATOSADJUDICATARIO': ['IdContrato', 'ChaveAdjudicatario'],
+    'TIPODOCONTRATO': ['IdContrato', 'ChaveTipo'],
+    'CONTRATOSCPV': ['IdContrato', 'CodCpv'],
+}
+
+
+def render_streamed(template_name, **context):
+    """Renderiza um template em blocos, enviando a página à medida que é gerada."""
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(STREAM_BUFFER_SIZE)
+    return Response(stream_with_context(stream), mimetype='text/html')
+
+
+def render_table_list(table_name, pk_field, display_fields):
+    """Listagem genérica de uma tabela, com linhas em tuplos lidas durante o envio."""
+    limit = min(max(request.args.get('limit', 100, type=int), 1), MAX_LIST_LIMIT)
+    columns, rows = db.iter_table(table_name, limit)
+
+    # Índices das colunas que compõem o URL de detalhe de cada registo
+    key_fields = COMPOSITE_KEYS.get(table_name, [pk_field])
+    lower_columns = [c.lower() for c in columns]
+    key_indexes = [lower_columns.index(f.lower()) for f in key_fields]
+
+    return render_streamed('table-list.html',
+                         columns=columns,
+                         rows=rows,
+                         table_name=table_name,
+                         key_indexes=key_indexes,
+                         display_fields=display_fields)
 
 @app.route('/')
 def index():
@@ -31,10 +81,128 @@ def contract(id):
     # Validar ID
     contract = db.get_contract_by_id(id)
     if contract:
-        return render_template('contract.html', contract=contract)
+        scores = dict(similarity.get_similar_contracts(id, k=10))
+        similar = [(row, scores[row['IdContrato']]) for row in db.get_contracts_by_ids(list(scores))]
+        return render_template('contract.html',
+                             contract=contract,
+                             similar=similar,
+                             benchmarks=db.get_price_benchmarks(id))
     return "Contrato não encontrado", 404
 
 
+@app.route('/outliers')
+def price_outliers():
+    """Contratos com preço fora do padrão do seu grupo (CPV, distrito)."""
+    limit = request.args.get('limit', 100, type=int)
+    tipo = request.args.get('tipo', '')
+    directions = {'': None, 'acima': 1, 'abaixo': -1}
+    if tipo not in directions:
+        abort(400)
+    outliers = db.get_price_outliers(min(max(limit, 1), 1000), directions[tipo])
+    return render_template('price-outliers.html',
+                         outliers=outliers,
+                         tipo=tipo,
+                         factor=benchmarks.OUTLIER_IQR_FACTOR)
+
+
+@app.route('/timeseries')
+def timeseries_view():
+    """Evolução do gasto e do número de contratos por dia, semana ou mês."""
+    campo = request.args.get('campo', 'publicacao')
+    dimensao = request.args.get('dimensao', 'total')
+    granularidade = request.args.get('granularidade', 'dia')
+    if campo not in timeseries.FIELDS or dimensao not in timeseries.DIMENSIONS \
+            or granularidade not in timeseries.GRANULARITIES:
+        abort(400)
+
+    valores = timeseries.dimension_values(dimensao) if dimensao != 'total' else []
+    valor = request.args.get('valor') or (valores[0][0] if valores else '')
+    serie = timeseries.get_series(campo, dimensao, valor)
+
+    pontos, total, inicio, fim = [], (0, 0.0), None, None
+    if serie:
+        try:
+            inicio = datetime.date.fromisoformat(request.args.get('inicio') or serie.start.isoformat())
+            fim = datetime.date.fromisoformat(request.args.get('fim') or serie.end.isoformat())
+        except ValueError:
+            abort(400)
+        pontos = serie.buckets(inicio, fim, granularidade)
+        total = serie.total(inicio, fim)
+
+    return render_template('timeseries.html',
+                         campo=campo,
+                         dimensao=dimensao,
+                         valor=valor,
+                         valores=valores,
+                         granularidade=granularidade,
+                         inicio=inicio,
+                         fim=fim,
+                         pontos=pontos,
+                         total=total,
+                         maximo=max((p[2] for p in pontos), default=0))
+
+
+@app.route('/cube')
+def cube_view():
+    """Tabela dinâmica do cubo, com detalhe por clique nas linhas."""
+    linhas = request.args.get('linhas', 'geo')
+    colunas = request.args.get('colunas', '')
+    medida = request.args.get('medida', 'gasto')
+    if linhas not in cube.DIMENSIONS or (colunas and (colunas not in cube.DIMENSIONS or colunas == linhas)) \
+            or medida not in ('contratos', 'gasto'):
+        abort(400)
+
+    filtros = {}
+    for dimensao in cube.DIMENSIONS:
+        chave = request.args.get(dimensao)
+        if chave:
+            try:
+                nivel = cube.key_level(dimensao, chave)
+            except ValueError:
+                abort(400)
+            if nivel >= len(cube.LEVELS[dimensao]):
+                abort(400)
+            filtros[dimensao] = chave
+
+    tabela = cube.pivot(linhas, colunas, filtros)
+    rotulos = {dimensao: cube.labels(dimensao) for dimensao in {linhas, colunas, *filtros} if dimensao}
+    indice = 0 if medida == 'contratos' else 1
+
+    def ordenar(dimensao, chaves, totais):
+        if dimensao == 'mes':
+            return sorted(chaves)
+        if dimensao == linhas:
+            return sorted(chaves, key=lambda chave: totais[chave][indice] or 0, reverse=True)
+        return sorted(chaves, key=lambda chave: rotulos[dimensao].get(chave, chave))
+
+    nivel_linhas = cube.child_level(linhas, filtros)
+
+    def ligacao(dimensao, chave):
+        """URL da mesma vista com o filtro de uma dimensão alterado."""
+        parametros = {'linhas': linhas, 'colunas': colunas, 'medida': medida, **filtros, dimensao: chave}
+        return url_for('cube_view', **{nome: valor for nome, valor in parametros.items() if valor})
+
+    # Filtros ativos, cada um com a chave do nível acima para subir
+    caminho = [(dimensao, chave, cube.parent_key(dimensao, chave)) for dimensao, chave in filtros.items()]
+
+    return render_template('cube.html',
+                         linhas=linhas,
+                         colunas=colunas,
+                         medida=medida,
+                         indice=indice,
+                         filtros=filtros,
+                         caminho=caminho,
+                         ligacao=ligacao,
+                         rotulos=rotulos,
+                         nomes=cube.DIMENSION_NAMES,
+                         niveis=cube.LEVELS,
+                         nivel_linhas=nivel_linhas,
+                         pode_detalhar=nivel_linhas < len(cube.LEVELS[linhas]) - 1,
+                         chaves_linhas=ordenar(linhas, tabela['row_keys'], tabela['row_totals']),
+                         chaves_colunas=ordenar(colunas, tabela['column_keys'], tabela['column_totals']) if colunas else [],
+                         tabela=tabela)
+
+
 @app.route('/search')
 def contract_search():
     """Pesquisa de contratos com proteção contra DoS.
@@ -43,14 +211,37 @@ def contract_search():
     """
     # Validar query string
     query = request.args.get('q', '')
-    contracts = []
+    contracts, entidades = [], []
     if query:
         contracts = db.search_contracts(query)
+        # A caixa da barra de navegação pesquisa entidades por nome ou NIF
+        entidades = entity_suggestions(query, 20)
     return render_template('contract-search.html', 
                          contracts=contracts, 
+                         entidades=entidades,
                          query=query)
 
 
+def entity_suggestions(text, limit):
+    """Adjudicantes e adjudicatários cujo nome ou NIF começa por text, com a ligação de cada um."""
+    sugestoes = []
+    for tipo, chave, nif, designacao, contratos in autocomplete.suggest(text, limit):
+        if tipo == 'adjudicante':
+            url = url_for('entity', id=chave)
+        else:
+            url = url_for('adjudicatario_detail', k=chave)
+        sugestoes.append({'tipo': tipo, 'designacao': designacao, 'nif': nif,
+                          'contratos': contratos, 'url': url})
+    return sugestoes
+
+
+@app.route('/autocomplete')
+def autocomplete_view():
+    """Sugestões de adjudicantes e adjudicatários (JSON) para a caixa de pesquisa."""
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 50)
+    return jsonify(entity_suggestions(request.args.get('q', ''), limit))
+
+
 @app.route('/entities')
 def entity_list():
     """Lista de entidades."""
@@ -75,12 +266,9 @@ def entity(id):
 @app.route('/ADJUDICANTE/')
 def adjudicante_list():
     """Lista todos os adjudicantes."""
-    adjudicantes = db.get_all_adjudicantes()
-    return render_template('table-list.html', 
-                         records=adjudicantes, 
-                         table_name='ADJUDICANTE',
-                         pk_field='NIFAdjudicante',
-                         display_fields=['NIFAdjudicante', 'designacao'])
+    return render_table_list('ADJUDICANTE',
+                             pk_field='NIFAdjudicante',
+                             display_fields=['NIFAdjudicante', 'designacao'])
 
 
 @app.route('/ADJUDICANTE/<int:k>/')
@@ -98,12 +286,9 @@ def adjudicante_detail(k):
 @app.route('/ADJUDICATARIO/')
 def adjudicatario_list():
     """Lista todos os adjudicatários."""
-    adjudicatarios = db.get_all_adjudicatarios()
-    return render_template('table-list.html', 
-                         records=adjudicatarios, 
-                         table_name='ADJUDICATARIO',
-                         pk_field='ChaveAdjudicatario',
-                         display_fields=['ChaveAdjudicatario', 'NIFAdjudicatario', 'designacao'])
+    return render_table_list('ADJUDICATARIO',
+                             pk_field='ChaveAdjudicatario',
+                             display_fields=['ChaveAdjudicatario', 'NIFAdjudicatario', 'designacao'])
 
 
 @app.route('/ADJUDICATARIO/<int:k>/')
@@ -121,12 +306,9 @@ def adjudicatario_detail(k):
 @app.route('/CONTRATOS/')
 def contratos_list():
     """Lista todos os contratos."""
-    contratos = db.get_all_contracts()
-    return render_template('table-list.html', 
-                         records=contratos, 
-                         table_name='CONTRATOS',
-                         pk_field='IdContrato',
-                         display_fields=['IdContrato', 'TipoProcedimento', 'ObjetivoContrato', 'DataPublicacao', 'preco'])
+    return render_table_list('CONTRATOS',
+                             pk_field='IdContrato',
+                             display_fields=['IdContrato', 'TipoProcedimento', 'ObjetivoContrato', 'DataPublicacao', 'preco'])
 
 
 @app.route('/CONTRATOS/<int:k>/')
@@ -136,7 +318,8 @@ def contratos_detail(k):
     if contrato:
         return render_template('table-detail.html', 
                              record=contrato,
-                             table_name='CONTRATOS')
+                             table_name='CONTRATOS',
+                             benchmarks=db.get_price_benchmarks(k))
     return "Contrato não encontrado", 404
 
 
@@ -144,12 +327,9 @@ def contratos_detail(k):
 @app.route('/PAIS/')
 def pais_list():
     """Lista todos os países."""
-    paises = db.get_all_paises()
-    return render_template('table-list.html', 
-                         records=paises, 
-                         table_name='PAIS',
-                         pk_field='IdPais',
-                         display_fields=['IdPais', 'Designacao'])
+    return render_table_list('PAIS',
+                             pk_field='IdPais',
+                             display_fields=['IdPais', 'Designacao'])
 
 
 @app.route('/PAIS/<int:k>/')
@@ -167,12 +347,9 @@ def pais_detail(k):
 @app.route('/DISTRITO/')
 def distrito_list():
     """Lista todos os distritos."""
-    distritos = db.get_all_distritos()
-    return render_template('table-list.html', 
-                         records=distritos, 
-                         table_name='DISTRITO',
-                         pk_field='IdDistrito',
-                         display_fields=['IdDistrito', 'NomeDistrito'])
+    return render_table_list('DISTRITO',
+                             pk_field='IdDistrito',
+                             display_fields=['IdDistrito', 'NomeDistrito'])
 
 
 @app.route('/DISTRITO/<int:k>/')
@@ -190,12 +367,9 @@ def distrito_detail(k):
 @app.route('/MUNICIPIO/')
 def municipio_list():
     """Lista todos os municípios."""
-    municipios = db.get_all_municipios()
-    return render_template('table-list.html', 
-                         records=municipios, 
-                         table_name='MUNICIPIO',
-                         pk_field='IdMunicipio',
-                         display_fields=['IdMunicipio', 'NomeMunicipio'])
+    return render_table_list('MUNICIPIO',
+                             pk_field='IdMunicipio',
+                             display_fields=['IdMunicipio', 'NomeMunicipio'])
 
 
 @app.route('/MUNICIPIO/<int:k>/')
@@ -213,12 +387,9 @@ def municipio_detail(k):
 @app.route('/CPV/')
 def cpv_list():
     """Lista todos os CPVs."""
-    cpvs = db.get_all_cpvs()
-    return render_template('table-list.html', 
-                         records=cpvs, 
-                         table_name='CPV',
-                         pk_field='CodCpv',
-                         display_fields=['CodCpv', 'designacao'])
+    return render_table_list('CPV',
+                             pk_field='CodCpv',
+                             display_fields=['CodCpv', 'designacao'])
 
 
 @app.route('/CPV/<string:k>/')
@@ -236,12 +407,9 @@ def cpv_detail(k):
 @app.route('/TIPOS/')
 def tipos_list():
     """Lista todos os tipos."""
-    tipos = db.get_all_tipos()
-    return render_template('table-list.html', 
-                         records=tipos, 
-                         table_name='TIPOS',
-                         pk_field='ChaveTipo',
-                         display_fields=['ChaveTipo', 'Tipo'])
+    return render_table_list('TIPOS',
+                             pk_field='ChaveTipo',
+                             display_fields=['ChaveTipo', 'Tipo'])
 
 
 @app.route('/TIPOS/<int:k>/')
@@ -259,12 +427,9 @@ def tipos_detail(k):
 @app.route('/LOCALIZACAOCONTRATOS/')
 def localizacao_list():
     """Lista todas as localizações de contratos."""
-    localizacoes = db.get_all_localizacoes()
-    return render_template('table-list.html', 
-                         records=localizacoes, 
-                         table_name='LOCALIZACAOCONTRATOS',
-                         pk_field='ChaveLocalizacao',
-                         display_fields=['ChaveLocalizacao', 'IdContrato', 'IdPais', 'IdDistrito', 'IdMunicipio'])
+    return render_table_list('LOCALIZACAOCONTRATOS',
+                             pk_field='ChaveLocalizacao',
+                             display_fields=['ChaveLocalizacao', 'IdContrato', 'IdPais', 'IdDistrito', 'IdMunicipio'])
 
 
 @app.route('/LOCALIZACAOCONTRATOS/<int:k>/')
@@ -282,12 +447,9 @@ def localizacao_detail(k):
 @app.route('/CONTRATOSADJUDICATARIO/')
 def contratos_adjudicatario_list():
     """Lista todos os contratos-adjudicatário."""
-    contratos_adj = db.get_all_contratos_adjudicatario()
-    return render_template('table-list.html', 
-                         records=contratos_adj, 
-                         table_name='CONTRATOSADJUDICATARIO',
-                         pk_field='composite',
-                         display_fields=['IdContrato', 'ChaveAdjudicatario'])
+    return render_table_list('CONTRATOSADJUDICATARIO',
+                             pk_field='composite',
+                             display_fields=['IdContrato', 'ChaveAdjudicatario'])
 
 
 @app.route('/CONTRATOSADJUDICATARIO/<int:id_contrato>/<int:chave_adjudicatario>/')
@@ -305,12 +467,9 @@ def contratos_adjudicatario_detail(id_contrato, chave_adjudicatario):
 @app.route('/TIPODOCONTRATO/')
 def tipo_contrato_list():
     """Lista todos os tipo-contrato."""
-    tipos_contrato = db.get_all_tipo_contrato()
-    return render_template('table-list.html', 
-                         records=tipos_contrato, 
-                         table_name='TIPODOCONTRATO',
-                         pk_field='composite',
-                         display_fields=['IdContrato', 'ChaveTipo'])
+    return render_table_list('TIPODOCONTRATO',
+                             pk_field='composite',
+                             display_fields=['IdContrato', 'ChaveTipo'])
 
 
 @app.route('/TIPODOCONTRATO/<int:id_contrato>/<int:chave_tipo>/')
@@ -328,12 +487,9 @@ def tipo_contrato_detail(id_contrato, chave_tipo):
 @app.route('/CONTRATOSCPV/')
 def contratos_cpv_list():
     """Lista todos os contratos-CPV."""
-    contratos_cpv = db.get_all_contratos_cpv()
-    return render_template('table-list.html', 
-                         records=contratos_cpv, 
-                         table_name='CONTRATOSCPV',
-                         pk_field='composite',
-                         display_fields=['IdContrato', 'CodCpv'])
+    return render_table_list('CONTRATOSCPV',
+                             pk_field='composite',
+                             display_fields=['IdContrato', 'CodCpv'])
 
 
 @app.route('/CONTRATOSCPV/<int:id_contrato>/<string:cod_cpv>/')
@@ -366,23 +522,72 @@ SQL_QUESTIONS = {
     15: ("Pergunta 15: Para cada distrito, mostre o número total de contratos, total de adjudicantes e total de adjudicatários distintos envolvidos. Ordene a partir do distrito com maior número de contratos", db.get_ex15),
 }
 
+# Perguntas demasiado pesadas para correr dentro do pedido: são executadas
+# pelos trabalhadores da fila (arrancados pelo server.py ou por python jobs.py worker)
+BACKGROUND_QUESTIONS = {13, 14}
+
 @app.route('/sql_question')
 def sql_question():
     """Executa e exibe resultados de interrogações SQL."""
     q = request.args.get('q', type=int)
     if not q or q not in SQL_QUESTIONS:
-        return render_template('sql_question.html', q=None, results=None, error="Pergunta inválida")
+        return render_template('sql_question.html', q=None, columns=None, results=None, error="Pergunta inválida")
     
     titulo, funcao = SQL_QUESTIONS[q]
-    results = None
+    columns, results = None, None
     error = None
+
+    if q in BACKGROUND_QUESTIONS:
+        # Executada no pedido só se a última execução igual tiver sido rápida
+        job_id = jobs.run('sql_question', {'q': q})
+        resultado = jobs.get_result(job_id)
+        if resultado is None:
+            return render_template('job.html', job=jobs.get_job(job_id), titulo=titulo,
+                                   trabalhadores=jobs.workers_available())
+        dados = json.loads(resultado[1])
+        return render_streamed('sql_question.html', q=q, titulo=titulo,
+                               columns=dados['columns'], results=dados['rows'], error=None)
     
     try:
-        results = funcao()
+        columns, results = funcao()
     except Exception as e:
         error = f"Erro ao executar a pergunta: {str(e)}"
     
-    return render_template('sql_question.html', q=q, titulo=titulo, results=results, error=error)
+    return render_streamed('sql_question.html', q=q, titulo=titulo, columns=columns, results=results, error=error)
+
+
+@app.route('/export/<string:table_name>/')
+def export_table(table_name):
+    """Exportação completa de uma tabela para CSV, executada em segundo plano."""
+    if table_name.upper() not in db.ALLOWED_TABLES:
+        abort(404)
+    job_id = jobs.run('export', {'table': table_name.upper()})
+    return render_template('job.html', job=jobs.get_job(job_id), titulo=f"Exportação de {table_name.upper()}",
+                           trabalhadores=jobs.workers_available())
+
+
+@app.route('/jobs/<string:job_id>')
+def job_status(job_id):
+    """Estado de uma tarefa em segundo plano (JSON), para acompanhar o progresso."""
+    job = jobs.get_job(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job)
+
+
+@app.route('/jobs/<string:job_id>/result')
+def job_result(job_id):
+    """Resultado de uma tarefa concluída: CSV para exportações, JSON para perguntas."""
+    job = jobs.get_job(job_id)
+    resultado = jobs.get_result(job_id)
+    if job is None or resultado is None:
+        abort(404)
+    formato, texto = resultado
+    if formato == 'csv':
+        nome = f"{job['Parametros'].get('table', 'exportacao')}.csv"
+        return Response(texto, mimetype='text/csv',
+                        headers={'Content-Disposition': f'attachment; filename={nome}'})
+    return Response(texto, mimetype='application/json')
 
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
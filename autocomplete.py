@@ -0,0 +1,187 @@
+"""
+Sugestões de entidades enquanto se escreve (adjudicantes e adjudicatários).
+Contratos Públicos Portugal 2024
+
+Cada processo web mantém em memória um índice de prefixos: uma lista
+ordenada de chaves sem acentos, uma por cada palavra da designação (a chave
+é o resto da designação a partir dessa palavra) e uma por NIF. Uma pesquisa
+é uma procura binária seguida de uma leitura sequencial das chaves com o
+mesmo prefixo, pelo que 'saude' encontra "Administração Regional de Saúde".
+Os prefixos com mais de MAX_SCAN chaves (em geral os de 2 ou 3 letras) têm as
+melhores entidades calculadas na construção do índice, para que a ordenação
+não fique limitada às primeiras chaves por ordem alfabética.
+
+O índice é reconstruído quando o ficheiro da base de dados muda.
+"""
+
+import logging
+import os
+import re
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from heapq import nsmallest
+
+import db
+from text_utils import STOPWORDS, fold_accents
+
+
+# Pesquisas mais curtas devolvem demasiadas entidades para serem úteis
+MIN_QUERY_LENGTH = 2
+
+# Número máximo de chaves lidas por pesquisa; prefixos com mais chaves são pré-calculados
+MAX_SCAN = 2000
+
+# Entidades guardadas por cada prefixo pré-calculado (o limite máximo de /autocomplete)
+TOP_K = 50
+
+# As chaves são truncadas: prefixos mais longos raramente distinguem entidades
+MAX_KEY_LENGTH = 40
+
+_SEPARATOR_RE = re.compile(r'[^a-z0-9]+')
+
+# Maior que qualquer carácter de uma chave normalizada: limite superior de um prefixo
+_KEY_END = '{'
+
+ENTITY_QUERIES = {
+    'adjudicante': """
+        SELECT a.NIFAdjudicante, a.NIFAdjudicante, a.designacao, COUNT(c.IdContrato)
+        FROM ADJUDICANTE a
+        LEFT JOIN CONTRATOS c ON c.NIFAdjudicante = a.NIFAdjudicante
+        GROUP BY a.NIFAdjudicante
+    """,
+    'adjudicatario': """
+        SELECT a.ChaveAdjudicatario, a.NIFAdjudicatario, a.designacao, COUNT(ca.IdContrato)
+        FROM ADJUDICATARIO a
+        LEFT JOIN CONTRATOSADJUDICATARIO ca ON ca.ChaveAdjudicatario = a.ChaveAdjudicatario
+        GROUP BY a.ChaveAdjudicatario
+    """,
+}
+
+
+def normalize(text):
+    """Texto sem acentos, em minúsculas, com separadores reduzidos a um espaço."""
+    return _SEPARATOR_RE.sub(' ', fold_accents(text)).strip()
+
+
+class PrefixIndex:
+    """Índice ordenado de chaves normalizadas para pesquisa por prefixo."""
+
+    def __init__(self, entities):
+        # entities: lista de (tipo, chave, nif, designação, n.º de contratos)
+        self.entities = entities
+        postings = []
+        for number, (_, _, nif, designacao, _) in enumerate(entities):
+            name = normalize(designacao)
+            words = name.split(' ')
+            offset = 0
+            for position, word in enumerate(words):
+                if word and (position == 0 or (len(word) > 1 and word not in STOPWORDS)):
+                    postings.append((name[offset:offset + MAX_KEY_LENGTH], number, min(position, 255)))
+                offset += len(word) + 1
+            if nif:
+                postings.append((normalize(nif).replace(' ', ''), number, 0))
+        postings.sort()
+
+        self.keys = [key for key, _, _ in postings]
+        self.numbers = array('l', (number for _, number, _ in postings))
+        self.positions = array('B', (position for _, _, position in postings))
+        # Critérios de ordenação que não dependem da pesquisa, calculados uma vez
+        self.ranks = [(-contratos, len(designacao), designacao) for _, _, _, designacao, contratos in entities]
+        self.top = self._precompute_top()
+
+    def _rank(self, start, end, limit):
+        """As melhores entidades das chaves entre start e end.
+
+        Ordenação: correspondência no início do nome ou NIF, depois mais
+        contratos, depois nome mais curto.
+        """
+        # Para cada entidade, a palavra mais à esquerda que corresponde
+        best = {}
+        for number, position in zip(self.numbers[start:end], self.positions[start:end]):
+            if position < best.get(number, 256):
+                best[number] = position
+
+        ranks = self.ranks
+        return nsmallest(limit, best, key=lambda number: (best[number] > 0, ranks[number]))
+
+    def _precompute_top(self):
+        """Melhores entidades de cada prefixo com mais de MAX_SCAN chaves."""
+        keys, top = self.keys, {}
+        length, found = MIN_QUERY_LENGTH, True
+        while found:
+            found, start = False, 0
+            while start < len(keys):
+                prefix = keys[start][:length]
+                if len(prefix) < length:
+                    # Chaves mais curtas do que length não têm um prefixo deste comprimento
+                    start = bisect_right(keys, prefix, start)
+                    continue
+                end = bisect_left(keys, prefix + _KEY_END, start)
+                if end - start > MAX_SCAN:
+                    top[prefix] = self._rank(start, end, TOP_K)
+                    found = True
+                start = end
+            length += 1
+        return top
+
+    def search(self, text, limit=10):
+        """Entidades cujo nome tem uma palavra a começar por text, ou cujo NIF começa por text."""
+        prefix = normalize(text)[:MAX_KEY_LENGTH]
+        if len(prefix) < MIN_QUERY_LENGTH:
+            return []
+
+        if prefix in self.top and limit <= TOP_K:
+            top = self.top[prefix][:limit]
+        else:
+            start = bisect_left(self.keys, prefix)
+            top = self._rank(start, bisect_left(self.keys, prefix + _KEY_END, start), limit)
+        return [self.entities[number] for number in top]
+
+
+def load_entities():
+    """Lê as entidades das duas tabelas com o respetivo número de contratos."""
+    entities = []
+    for tipo, query in ENTITY_QUERIES.items():
+        for chave, nif, designacao, contratos in db.execute_query(query):
+            entities.append((tipo, chave, str(nif) if nif is not None else '', designacao or '', contratos))
+    return entities
+
+
+def _data_version():
+    """Assinatura do ficheiro da base de dados (e do WAL, se existir)."""
+    version = []
+    for path in (db.DATABASE, db.DATABASE + '-wal'):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        version.append((stat.st_mtime_ns, stat.st_size))
+    return tuple(version)
+
+
+# Índice por processo, reconstruído quando a base de dados muda
+_cache = {'version': None, 'index': None}
+_cache_lock = threading.Lock()
+
+
+def get_index():
+    """Retorna o PrefixIndex atual, reconstruindo-o se os dados mudaram."""
+    version = _data_version()
+    if version == _cache['version']:
+        return _cache['index']
+    with _cache_lock:
+        if version != _cache['version']:
+            try:
+                _cache['index'] = PrefixIndex(load_entities())
+            except Exception as e:
+                logging.error(f'Erro ao construir índice de sugestões: {e}')
+                _cache['index'] = PrefixIndex([])
+            _cache['version'] = version
+            logging.info(f"Índice de sugestões: {len(_cache['index'].keys)} chaves")
+        return _cache['index']
+
+
+def suggest(text, limit=10):
+    """Sugestões para o texto escrito, como lista de (tipo, chave, nif, designação, contratos)."""
+    return get_index().search(text, limit)
@@ -0,0 +1,133 @@
+"""
+Referências de preço por CPV e distrito.
+Contratos Públicos Portugal 2024
+
+Pré-calcula, para cada grupo de pares (CPV, distrito) e (CPV, todo o país),
+a distribuição dos preços: mediana, quartis, percentis 10/90 e limites de
+outlier. Guarda também o percentil de cada contrato dentro de cada grupo a
+que pertence, de modo que as páginas de contrato só fazem uma consulta
+indexada em vez de ordenar o grupo em cada visita.
+
+Os grupos são ordenados de forma exata: mesmo os maiores CPVs têm poucos
+milhares de contratos, pelo que um sketch de quantis não compensaria.
+
+Utilização:
+    python benchmarks.py
+"""
+
+import logging
+import math
+import sqlite3
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+
+import db
+
+
+# Grupos com menos contratos não têm estatísticas fiáveis
+MIN_GROUP_SIZE = 5
+
+# Limites de Tukey "far out": Q1 - k*IQR e Q3 + k*IQR
+OUTLIER_IQR_FACTOR = 3.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS PRECOSCPV (
+    CodCpv     VARCHAR (12),
+    IdDistrito NUMBER (2),
+    N          INTEGER,
+    Minimo     REAL,
+    P10        REAL,
+    Q1         REAL,
+    Mediana    REAL,
+    Q3         REAL,
+    P90        REAL,
+    Maximo     REAL,
+    Media      REAL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS IDX_PRECOSCPV ON PRECOSCPV (CodCpv, IFNULL(IdDistrito, 0));
+
+CREATE TABLE IF NOT EXISTS PRECOSCONTRATO (
+    IdContrato NUMBER (10),
+    CodCpv     VARCHAR (12),
+    IdDistrito NUMBER (2),
+    Percentil  REAL,
+    Outlier    INTEGER
+);
+CREATE INDEX IF NOT EXISTS IDX_PRECOSCONTRATO ON PRECOSCONTRATO (IdContrato);
+CREATE INDEX IF NOT EXISTS IDX_PRECOSCONTRATO_OUTLIER ON PRECOSCONTRATO (Outlier, IdDistrito);
+"""
+
+
+def quantile(sorted_values, q):
+    """Quantil q (0 a 1) com interpolação linear entre pontos de uma lista ordenada."""
+    position = (len(sorted_values) - 1) * q
+    lower = math.floor(position)
+    upper = math.ceil(position)
+    if lower == upper:
+        return sorted_values[lower]
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def percent_rank(sorted_values, value):
+    """Percentagem de pares com preço inferior (empates contam metade)."""
+    below = bisect_left(sorted_values, value)
+    equal = bisect_right(sorted_values, value) - below
+    return 100.0 * (below + 0.5 * equal) / len(sorted_values)
+
+
+def _peer_groups(conn):
+    """Agrupa (IdContrato, preço) por (CPV, distrito) e por (CPV, país)."""
+    query = """
+        SELECT DISTINCT c.IdContrato, c.preco, cc.CodCpv, l.IdDistrito
+        FROM CONTRATOS c
+        JOIN CONTRATOSCPV cc ON cc.IdContrato = c.IdContrato
+        LEFT JOIN LOCALIZACAOCONTRATOS l ON l.IdContrato = c.IdContrato
+        WHERE c.preco IS NOT NULL
+    """
+    groups = defaultdict(dict)
+    for id_contrato, preco, cod_cpv, id_distrito in conn.execute(query):
+        if id_distrito is not None:
+            groups[(cod_cpv, id_distrito)][id_contrato] = preco
+        groups[(cod_cpv, None)][id_contrato] = preco
+    return groups
+
+
+def build(conn):
+    """Recalcula as tabelas PRECOSCPV e PRECOSCONTRATO."""
+    conn.executescript(SCHEMA)
+    groups = _peer_groups(conn)
+
+    group_rows, contract_rows = [], []
+    for (cod_cpv, id_distrito), prices in groups.items():
+        if len(prices) < MIN_GROUP_SIZE:
+            continue
+        values = sorted(prices.values())
+        q1, q3 = quantile(values, 0.25), quantile(values, 0.75)
+        iqr = q3 - q1
+        low, high = q1 - OUTLIER_IQR_FACTOR * iqr, q3 + OUTLIER_IQR_FACTOR * iqr
+        group_rows.append((cod_cpv, id_distrito, len(values), values[0], quantile(values, 0.1), q1,
+                           quantile(values, 0.5), q3, quantile(values, 0.9), values[-1],
+                           sum(values) / len(values)))
+        for id_contrato, preco in prices.items():
+            outlier = 1 if preco > high else (-1 if preco < low else 0)
+            contract_rows.append((id_contrato, cod_cpv, id_distrito, percent_rank(values, preco), outlier))
+
+    try:
+        conn.execute("DELETE FROM PRECOSCPV")
+        conn.execute("DELETE FROM PRECOSCONTRATO")
+        conn.executemany("INSERT INTO PRECOSCPV VALUES (?,?,?,?,?,?,?,?,?,?,?)", group_rows)
+        conn.executemany("INSERT INTO PRECOSCONTRATO VALUES (?,?,?,?,?)", contract_rows)
+        conn.commit()
+    except sqlite3.Error as e:
+        logging.error(f'Erro ao gravar referências de preço: {e}')
+        conn.rollback()
+        raise
+    logging.info(f'Referências de preço: {len(group_rows)} grupos, {len(contract_rows)} posições de contratos')
+
+
+if __name__ == '__main__':
+    conn = db.get_connection()
+    try:
+        build(conn)
+    finally:
+        db.close_connection(conn)
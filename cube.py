@@ -0,0 +1,260 @@
+"""
+Cubo OLAP de contratos: geografia × CPV × tipo de procedimento × mês.
+Contratos Públicos Portugal 2024
+
+Pré-agrega o número de contratos e o gasto para todas as combinações de
+níveis das quatro dimensões (incluindo o nível "todos" de cada uma), de modo
+que qualquer fatia, agregação ou detalhe é uma consulta indexada à tabela
+CUBO, sem voltar a juntar LOCALIZACAOCONTRATOS, CONTRATOSCPV e CONTRATOS.
+
+Níveis de cada dimensão (0 = todos):
+- geo: 1 país, 2 distrito, 3 município; chave em caminho 'IdPais/IdDistrito/IdMunicipio'
+- cpv: 1 divisão (2 dígitos), 2 grupo (3), 3 classe (4), 4 categoria (5); chave é o prefixo
+- procedimento: 1 tipo de procedimento
+- mes: 1 mês de celebração (ou de publicação, se faltar), 'AAAA-MM'
+
+Um contrato com várias localizações ou CPVs conta uma única vez em cada
+célula a que pertence.
+
+Utilização:
+    python cube.py
+"""
+
+import itertools
+import logging
+import sqlite3
+
+import db
+
+
+DIMENSIONS = ('geo', 'cpv', 'procedimento', 'mes')
+
+LEVELS = {
+    'geo': ['Todos', 'País', 'Distrito', 'Município'],
+    'cpv': ['Todos', 'Divisão', 'Grupo', 'Classe', 'Categoria'],
+    'procedimento': ['Todos', 'Tipo de procedimento'],
+    'mes': ['Todos', 'Mês'],
+}
+
+DIMENSION_NAMES = {
+    'geo': 'Localização',
+    'cpv': 'CPV',
+    'procedimento': 'Procedimento',
+    'mes': 'Mês',
+}
+
+CPV_DIGITS = [0, 2, 3, 4, 5]
+
+# Expressão SQL (sobre FACTOS) da chave de cada dimensão em cada nível
+KEY_EXPRESSIONS = {
+    'geo': ["''", "CAST(IdPais AS TEXT)", "IdPais || '/' || IdDistrito",
+            "IdPais || '/' || IdDistrito || '/' || IdMunicipio"],
+    'cpv': ["''"] + [f"substr(Cpv, 1, {digits})" for digits in CPV_DIGITS[1:]],
+    'procedimento': ["''", "TipoProcedimento"],
+    'mes': ["''", "Mes"],
+}
+
+COLUMNS = {'geo': 'Geo', 'cpv': 'Cpv', 'procedimento': 'Procedimento', 'mes': 'Mes'}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS CUBO (
+    NivelGeo     INTEGER,
+    Geo          VARCHAR (20),
+    NivelCpv     INTEGER,
+    Cpv          VARCHAR (8),
+    NivelProc    INTEGER,
+    Procedimento VARCHAR (100),
+    NivelMes     INTEGER,
+    Mes          VARCHAR (7),
+    Contratos    INTEGER,
+    Gasto        REAL
+);
+CREATE INDEX IF NOT EXISTS IDX_CUBO ON CUBO (NivelGeo, NivelCpv, NivelProc, NivelMes);
+
+CREATE TABLE IF NOT EXISTS CUBO_ROTULOS (
+    Dimensao VARCHAR (20),
+    Chave    VARCHAR (20),
+    Rotulo   VARCHAR (200),
+    PRIMARY KEY (Dimensao, Chave)
+);
+"""
+
+LEVEL_COLUMNS = {'geo': 'NivelGeo', 'cpv': 'NivelCpv', 'procedimento': 'NivelProc', 'mes': 'NivelMes'}
+
+FACTS_QUERY = """
+CREATE TEMP TABLE FACTOS AS
+SELECT DISTINCT c.IdContrato, c.preco,
+       l.IdPais, l.IdDistrito, l.IdMunicipio,
+       substr(cc.CodCpv, 1, 8) AS Cpv,
+       c.TipoProcedimento,
+       substr(COALESCE(c.DataCelebracaoContrato, c.DataPublicacao), 7, 4) || '-' ||
+       substr(COALESCE(c.DataCelebracaoContrato, c.DataPublicacao), 4, 2) AS Mes
+FROM CONTRATOS c
+LEFT JOIN LOCALIZACAOCONTRATOS l ON l.IdContrato = c.IdContrato
+LEFT JOIN CONTRATOSCPV cc ON cc.IdContrato = c.IdContrato
+"""
+
+
+def _build_labels(conn):
+    """Rótulos legíveis das chaves de localização e dos prefixos CPV."""
+    rows = []
+    names = {
+        1: dict(conn.execute("SELECT IdPais, Designacao FROM PAIS")),
+        2: dict(conn.execute("SELECT IdDistrito, NomeDistrito FROM DISTRITO")),
+        3: dict(conn.execute("SELECT IdMunicipio, NomeMunicipio FROM MUNICIPIO")),
+    }
+    for level in (1, 2, 3):
+        for (path,) in conn.execute("SELECT DISTINCT Geo FROM CUBO WHERE NivelGeo = ?", (level,)):
+            last = int(path.split('/')[-1])
+            rows.append(('geo', path, names[level].get(last) or path))
+
+    cpv_names = {code[:8]: name for code, name in conn.execute("SELECT CodCpv, designacao FROM CPV")}
+    for (prefix,) in conn.execute("SELECT DISTINCT Cpv FROM CUBO WHERE NivelCpv > 0"):
+        name = cpv_names.get(prefix.ljust(8, '0'))
+        rows.append(('cpv', prefix, f'{prefix} - {name}' if name else prefix))
+    return rows
+
+
+def build(conn):
+    """Recalcula o cubo para todas as combinações de níveis."""
+    conn.executescript(SCHEMA)
+    try:
+        conn.execute("DROP TABLE IF EXISTS temp.FACTOS")
+        conn.execute(FACTS_QUERY)
+        conn.execute("DELETE FROM CUBO")
+        conn.execute("DELETE FROM CUBO_ROTULOS")
+
+        for levels in itertools.product(*(range(len(LEVELS[d])) for d in DIMENSIONS)):
+            keys = [KEY_EXPRESSIONS[d][level] for d, level in zip(DIMENSIONS, levels)]
+            conn.execute(f"""
+                INSERT INTO CUBO
+                SELECT {levels[0]}, k0, {levels[1]}, k1, {levels[2]}, k2, {levels[3]}, k3,
+                       COUNT(*), SUM(preco)
+                FROM (SELECT DISTINCT IdContrato, preco,
+                             {keys[0]} AS k0, {keys[1]} AS k1, {keys[2]} AS k2, {keys[3]} AS k3
+                      FROM FACTOS)
+                WHERE k0 IS NOT NULL AND k1 IS NOT NULL AND k2 IS NOT NULL AND k3 IS NOT NULL
+                GROUP BY k0, k1, k2, k3
+            """)
+
+        conn.executemany("INSERT INTO CUBO_ROTULOS VALUES (?, ?, ?)", _build_labels(conn))
+        conn.execute("DROP TABLE temp.FACTOS")
+        conn.commit()
+    except sqlite3.Error as e:
+        logging.error(f'Erro ao construir o cubo: {e}')
+        conn.rollback()
+        raise
+    total = conn.execute("SELECT COUNT(*) FROM CUBO").fetchone()[0]
+    logging.info(f'Cubo construído: {total} células')
+
+
+def key_level(dimension, key):
+    """Nível correspondente a uma chave de uma dimensão ('' é o nível 0)."""
+    if not key:
+        return 0
+    if dimension == 'geo':
+        return key.count('/') + 1
+    if dimension == 'cpv':
+        return CPV_DIGITS.index(len(key))
+    return 1
+
+
+def query(levels, filters):
+    """Células do cubo para os níveis pedidos, restritas pelos filtros.
+
+    levels: {dimensão: nível}; dimensões omitidas ficam no nível 0 (todos).
+    filters: {dimensão: chave}; as células têm de estar dentro dessa chave
+    (o mesmo caminho geográfico, o mesmo prefixo CPV ou o mesmo valor).
+    Retorna uma lista de sqlite3.Row com Geo, Cpv, Procedimento, Mes,
+    Contratos e Gasto, vazia se o cubo ainda não tiver sido construído.
+    """
+    conditions, params = [], []
+    for dimension in DIMENSIONS:
+        level = levels.get(dimension, 0)
+        key = filters.get(dimension)
+        if key and key_level(dimension, key) > level:
+            level = key_level(dimension, key)
+        conditions.append(f"{LEVEL_COLUMNS[dimension]} = ?")
+        params.append(level)
+        if key:
+            column = COLUMNS[dimension]
+            if dimension == 'geo':
+                conditions.append(f"({column} = ? OR {column} LIKE ?)")
+                params.extend([key, key + '/%'])
+            elif dimension == 'cpv':
+                conditions.append(f"{column} LIKE ?")
+                params.append(key + '%')
+            else:
+                conditions.append(f"{column} = ?")
+                params.append(key)
+
+    sql = f"SELECT Geo, Cpv, Procedimento, Mes, Contratos, Gasto FROM CUBO WHERE {' AND '.join(conditions)}"
+    try:
+        return db.execute_query(sql, tuple(params))
+    except Exception:
+        return []
+
+
+def parent_key(dimension, key):
+    """Chave um nível acima ('' quando o nível acima é "todos")."""
+    level = key_level(dimension, key)
+    if dimension == 'geo':
+        return key.rsplit('/', 1)[0] if level > 1 else ''
+    if dimension == 'cpv':
+        return key[:CPV_DIGITS[level - 1]]
+    return ''
+
+
+def child_level(dimension, filters):
+    """Nível imediatamente abaixo do filtro de uma dimensão (ou o mais fino)."""
+    return min(key_level(dimension, filters.get(dimension)) + 1, len(LEVELS[dimension]) - 1)
+
+
+def pivot(rows_dimension, columns_dimension, filters):
+    """Tabela dinâmica de uma dimensão por outra (ou só linhas), dentro dos filtros.
+
+    As linhas e colunas ficam um nível abaixo do respetivo filtro. Os totais
+    de linha, coluna e geral vêm das próprias células agregadas do cubo e não
+    da soma das células, porque um contrato pode pertencer a várias.
+    Retorna um dicionário com row_keys, column_keys, cells {(linha, coluna):
+    (contratos, gasto)}, row_totals, column_totals e total.
+    """
+    row_column = COLUMNS[rows_dimension]
+    levels = {rows_dimension: child_level(rows_dimension, filters)}
+    row_totals = {row[row_column]: (row['Contratos'], row['Gasto']) for row in query(levels, filters)}
+
+    cells, column_totals = {}, {}
+    if columns_dimension:
+        column_column = COLUMNS[columns_dimension]
+        column_levels = {columns_dimension: child_level(columns_dimension, filters)}
+        column_totals = {row[column_column]: (row['Contratos'], row['Gasto'])
+                         for row in query(column_levels, filters)}
+        for row in query({**levels, **column_levels}, filters):
+            cells[(row[row_column], row[column_column])] = (row['Contratos'], row['Gasto'])
+
+    total = query({}, filters)
+    return {
+        'row_keys': list(row_totals),
+        'column_keys': sorted(column_totals),
+        'cells': cells,
+        'row_totals': row_totals,
+        'column_totals': column_totals,
+        'total': (total[0]['Contratos'], total[0]['Gasto']) if total else (0, 0.0),
+    }
+
+
+def labels(dimension):
+    """Rótulos {chave: rótulo} de uma dimensão (vazio para procedimento e mês)."""
+    try:
+        rows = db.execute_query("SELECT Chave, Rotulo FROM CUBO_ROTULOS WHERE Dimensao = ?", (dimension,))
+    except Exception:
+        return {}
+    return {row['Chave']: row['Rotulo'] for row in rows}
+
+
+if __name__ == '__main__':
+    conn = db.get_connection()
+    try:
+        build(conn)
+    finally:
+        db.close_connection(conn)
@@ -21,7 +21,7 @@ logging.basicConfig(
 )
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DATABASE = os.path.join(BASE_DIR, 'contratos_publicos.db')
+DATABASE = os.environ.get('CONTRATOS_DB', os.path.join(BASE_DIR, 'contratos_publicos.db'))
 
 
 def get_connection():
@@ -71,6 +71,87 @@ def execute_query(query, params=None):
         close_connection(conn)
 
 
+def execute_query_tuples(query, params=None):
+    """Executa uma query SELECT e retorna (nomes das colunas, lista de tuplos).
+
+    Mais leve que execute_query para tabelas genéricas: não cria um sqlite3.Row
+    por linha nem obriga a procurar cada célula pelo nome da coluna.
+    """
+    conn = get_connection()
+    conn.row_factory = None
+    try:
+        cursor = conn.execute(query, params or ())
+        columns = [col[0] for col in cursor.description]
+        return columns, cursor.fetchall()
+    except sqlite3.Error as e:
+        logging.error(f'Erro ao executar query: {e}')
+        raise
+    finally:
+        close_connection(conn)
+
+
+def encoded_columns(conn):
+    """Colunas de CONTRATOS codificadas por dicionário (ver dict_encoding.py).
+
+    Retorna um conjunto vazio se CONTRATOS for uma tabela simples.
+    """
+    try:
+        row = conn.execute("SELECT Valor FROM CODIFICACAO_META WHERE Chave = 'colunas'").fetchone()
+    except sqlite3.Error:
+        return set()
+    return set(row[0].split(',')) if row else set()
+
+
+def execute_contratos_query(query, encoded_query, column, params=None):
+    """Como execute_query_tuples, mas usa encoded_query se column estiver codificada.
+
+    No modo codificado, encoded_query filtra e agrupa pelas chaves inteiras
+    de CONTRATOS_DADOS em vez de comparar o texto devolvido pela vista CONTRATOS.
+    """
+    conn = get_connection()
+    conn.row_factory = None
+    try:
+        sql = encoded_query if column in encoded_columns(conn) else query
+        cursor = conn.execute(sql, params or ())
+        columns = [col[0] for col in cursor.description]
+        return columns, cursor.fetchall()
+    except sqlite3.Error as e:
+        logging.error(f'Erro ao executar query: {e}')
+        raise
+    finally:
+        close_connection(conn)
+
+
+def iter_query(query, params=None, batch_size=500):
+    """Executa uma query SELECT e retorna (nomes das colunas, gerador de tuplos).
+
+    As linhas são lidas em blocos à medida que o gerador é consumido, pelo que
+    o resultado nunca está todo em memória. A conexão é fechada quando o
+    gerador termina ou é descartado; deve ser consumido na mesma thread.
+    """
+    conn = get_connection()
+    conn.row_factory = None
+    try:
+        cursor = conn.execute(query, params or ())
+        columns = [col[0] for col in cursor.description]
+    except sqlite3.Error as e:
+        logging.error(f'Erro ao executar query: {e}')
+        close_connection(conn)
+        raise
+
+    def rows():
+        try:
+            while True:
+                batch = cursor.fetchmany(batch_size)
+                if not batch:
+                    break
+                yield from batch
+        finally:
+            close_connection(conn)
+
+    return columns, rows()
+
+
 def execute_update(query, params=None):
     """Executa uma query INSERT, UPDATE ou DELETE."""
     conn = get_connection()
@@ -104,6 +185,16 @@ def get_contract_by_id(contract_id):
     return results[0] if results else None
 
 
+def get_contracts_by_ids(contract_ids):
+    """Retorna os contratos indicados, pela mesma ordem da lista de IDs."""
+    if not contract_ids:
+        return []
+    placeholders = ','.join('?' for _ in contract_ids)
+    query = f"SELECT * FROM CONTRATOS WHERE IdContrato IN ({placeholders})"
+    by_id = {row['IdContrato']: row for row in execute_query(query, tuple(contract_ids))}
+    return [by_id[i] for i in contract_ids if i in by_id]
+
+
 def search_contracts(search_term):
     """Pesquisa contratos por ID, objetivo do contrato ou tipo de procedimento."""
     query = """
@@ -114,6 +205,51 @@ def search_contracts(search_term):
     return execute_query(query, (term, term, term))
 
 
+# Referências de preço (tabelas criadas por benchmarks.py)
+def get_price_benchmarks(contract_id):
+    """Retorna a posição do preço de um contrato em cada grupo de pares (CPV, distrito)."""
+    try:
+        query = """
+            SELECT pc.CodCpv, cpv.designacao, d.NomeDistrito, p.N, p.Q1, p.Mediana, p.Q3,
+                   p.Q3 - p.Q1 AS IQR, pc.Percentil, pc.Outlier
+            FROM PRECOSCONTRATO pc
+            JOIN PRECOSCPV p ON p.CodCpv = pc.CodCpv AND IFNULL(p.IdDistrito, 0) = IFNULL(pc.IdDistrito, 0)
+            LEFT JOIN CPV cpv ON cpv.CodCpv = pc.CodCpv
+            LEFT JOIN DISTRITO d ON d.IdDistrito = pc.IdDistrito
+            WHERE pc.IdContrato = ?
+            ORDER BY pc.CodCpv, pc.IdDistrito IS NULL, d.NomeDistrito
+        """
+        return execute_query(query, (contract_id,))
+    except Exception:
+        return []
+
+
+def get_price_outliers(limit=100, direction=None):
+    """Retorna os contratos com preço fora dos limites do seu grupo (CPV, distrito).
+
+    direction: 1 só acima do limite superior, -1 só abaixo do inferior, None ambos.
+    Ordena pela distância ao limite ultrapassado, em múltiplos do IQR do grupo,
+    para que os outliers baixos não fiquem sempre atrás dos altos.
+    """
+    try:
+        query = """
+            SELECT pc.IdContrato, c.ObjetivoContrato, c.preco, pc.CodCpv, d.NomeDistrito,
+                   p.N, p.Mediana, pc.Percentil, pc.Outlier,
+                   (CASE WHEN pc.Outlier = 1 THEN c.preco - p.Q3 ELSE p.Q1 - c.preco END)
+                       / NULLIF(p.Q3 - p.Q1, 0) AS Desvio
+            FROM PRECOSCONTRATO pc
+            JOIN PRECOSCPV p ON p.CodCpv = pc.CodCpv AND p.IdDistrito = pc.IdDistrito
+            JOIN CONTRATOS c ON c.IdContrato = pc.IdContrato
+            JOIN DISTRITO d ON d.IdDistrito = pc.IdDistrito
+            WHERE pc.Outlier != 0 AND (? IS NULL OR pc.Outlier = ?)
+            ORDER BY Desvio DESC, ABS(c.preco - p.Mediana) DESC
+            LIMIT ?
+        """
+        return execute_query(query, (direction, direction, limit))
+    except Exception:
+        return []
+
+
 # Funções específicas para Entidades
 def get_all_entities(limit=100):
     """Retorna todas as entidades adjudicantes (com limite)."""
@@ -156,140 +292,149 @@ def get_total_entities():
 
 def get_ex1():
     try:
-        query= "select IdContrato, Preco, ObjetivoContrato from contratos where TipoProcedimento = 'Consulta Prévia';"
-        result = execute_query(query)     
+        query= "select IdContrato, Preco, ObjetivoContrato from contratos where TipoProcedimento = ?;"
+        encoded_query = ("select IdContrato, Preco, ObjetivoContrato from CONTRATOS_DADOS "
+                         "where TipoProcedimentoId = (select Id from DIC_TIPOPROCEDIMENTO where Valor = ?);")
+        result = execute_contratos_query(query, encoded_query, 'TipoProcedimento', ('Consulta Prévia',))
         return result  # Retornar todos os resultados, não result[0]['1º exercicio']
     except Exception:
-        return []
+        return [], []
 
 def get_ex2():
     try:
         query= "SELECT IdContrato, NIFAdjudicante, ObjetivoContrato FROM contratos WHERE Fundamentacao IS NULL OR Fundamentacao = '';"
-        result = execute_query(query)     
+        encoded_query = ("SELECT IdContrato, NIFAdjudicante, ObjetivoContrato FROM CONTRATOS_DADOS "
+                         "WHERE FundamentacaoId IS NULL OR FundamentacaoId = (SELECT Id FROM DIC_FUNDAMENTACAO WHERE Valor = '');")
+        result = execute_contratos_query(query, encoded_query, 'Fundamentacao')
         return result
     except Exception:
-        return []
+        return [], []
 
 def get_ex3():
     try:
         query= "select idContrato, TipoProcedimento from contratos natural join localizacaocontratos where idDistrito=3;"
-        result = execute_query(query)     
+        result = execute_query_tuples(query)     
         return result
     except Exception:
-        return []
+        return [], []
 
 def get_ex4():
     try:
         query= "select a.designacao, count(c.IdContrato) as quantidade from contratos c inner join adjudicante a on a.NIFAdjudicante = c.NIFAdjudicante group by c.NIFAdjudicante order by quantidade DESC;"
-        result = execute_query(query)     
+        result = execute_query_tuples(query)     
         return result
     except Exception:
-        return []
+        return [], []
 
 def get_ex5():
     try:
         query= "select m.NomeMunicipio, COUNT(c.IdContrato) as ContratosLongaDuracao from municipio m inner join localizacaocontratos l on m.IdMunicipio = l.IdMunicipio inner join contratos c on l.IdContrato = c.IdContrato where c.PrazoExecucao > 365 group by m.NomeMunicipio having COUNT(c.IdContrato) >= 5 order by ContratosLongaDuracao DESC;"
-        result = execute_query(query)     
+        result = execute_query_tuples(query)     
         return result
     except Exception:
-        return []
+        return [], []
 
 def get_ex6():
     try:
         # Parametrizado: usar LOWER() para case-insensitive e parametrizar o termo
         query= "SELECT designacao FROM adjudicante WHERE LOWER(designacao) LIKE LOWER(?) ORDER BY designacao"
-        result = execute_query(query, ('%Saúde%',))     
+        result = execute_query_tuples(query, ('%Saúde%',))     
         return result
     except Exception:
-        return []
+        return [], []
     
 def get_ex7():
     try:
         query= "select d.NomeDistrito, count(IdContrato) as quantidade from localizacaocontratos l natural join distrito d group by l.idDistrito order by quantidade DESC;"
-        result = execute_query(query)     
+        result = execute_query_tuples(query)     
         return result
     except Exception:
-        return []
+        return [], []
     
 def get_ex8():
     try:
         query= "select IdContrato, Preco from contratos order by Preco DESC limit 10;"
-        result = execute_query(query)     
+        result = execute_query_tuples(query)     
         return result
     except Exception:
-        return []
+        return [], []
 
 def get_ex9():
     try:
         query= "select c.Designacao,avg(t.Preco) as PrecoMedio from CPV c inner join CONTRATOSCPV cc on c.CodCpv = cc.CodCpv inner join CONTRATOS t ON cc.IdContrato = t.IdContrato GROUP BY c.Designacao ORDER BY PrecoMedio DESC;"
-        result = execute_query(query)     
+        result = execute_query_tuples(query)     
         return result
     except Exception:
-        return []
+        return [], []
 
 def get_ex10():
     try:
         query= "select NomeDistrito, sum(Preco) as Preço_Total from contratos natural join localizacaocontratos natural join distrito group by idDistrito order by Preço_Total DESC;"
-        result = execute_query(query)     
+        result = execute_query_tuples(query)     
         return result
     except Exception:
-        return []
+        return [], []
 
 def get_ex11():
     try:
         query= "select TipoProcedimento, count(IdContrato) as qtd from contratos group by TipoProcedimento order by qtd DESC"
-        result = execute_query(query)     
+        # count(*) conta o mesmo (IdContrato é a chave primária) e é respondido só pelo índice da chave
+        encoded_query = ("select d.Valor as TipoProcedimento, c.qtd from "
+                         "(select TipoProcedimentoId, count(*) as qtd from CONTRATOS_DADOS group by TipoProcedimentoId) c "
+                         "left join DIC_TIPOPROCEDIMENTO d on d.Id = c.TipoProcedimentoId order by qtd DESC")
+        result = execute_contratos_query(query, encoded_query, 'TipoProcedimento')
         return result
     except Exception:
-        return []
+        return [], []
 
 def get_ex12():
     try:
         query= "select d.NomeDistrito, sum(c.Preco) as ValorTotal from contratos c inner join localizacaocontratos l on c.IdContrato = l.IdContrato inner join distrito d on l.IdDistrito = d.IdDistrito where substr(c.DataCelebracaoContrato, 7, 4) = '2024' group by d.NomeDistrito order by ValorTotal DESC;"
-        result = execute_query(query)     
+        result = execute_query_tuples(query)     
         return result
     except Exception:
-        return []
+        return [], []
 
 def get_ex13():
     try:
         query= "SELECT c.IdContrato, m.NomeMunicipio, c.Preco FROM Contratos c JOIN LocalizacaoContratos l ON c.IdContrato = l.IdContrato JOIN (SELECT l2.IdMunicipio, AVG(c2.Preco) AS PrecoMedio FROM LocalizacaoContratos l2 JOIN Contratos c2 ON c2.IdContrato = l2.IdContrato GROUP BY l2.IdMunicipio) pm ON pm.IdMunicipio = l.IdMunicipio JOIN Municipio m ON m.IdMunicipio = l.IdMunicipio WHERE c.Preco > pm.PrecoMedio ORDER BY m.NomeMunicipio, c.Preco DESC; "
-        result = execute_query(query)     
+        result = execute_query_tuples(query)     
         return result
     except Exception:
-        return []
+        return [], []
 
 def get_ex14():
     try:
         query= "select ca.chaveadjudicatario, a.designacao from contratosadjudicatario ca inner join adjudicatario a on a.chaveadjudicatario = ca.chaveadjudicatario inner join localizacaocontratos l on l.idcontrato = ca.idcontrato inner join distrito d on d.iddistrito = l.iddistrito group by ca.chaveadjudicatario, a.designacao having count(distinct d.IdDistrito) > 5; "
-        result = execute_query(query)     
+        result = execute_query_tuples(query)     
         return result
     except Exception:
-        return []
+        return [], []
 
 def get_ex15():
     try:
         query= "select d.nomedistrito, count(distinct c.idcontrato) as totalcontratos, count(distinct c.nifadjudicante) as totaladjudicantes, count(distinct ca.chaveadjudicatario) as totaladjudicatarios from distrito d inner join localizacaocontratos l on l.iddistrito = d.iddistrito inner join contratos c on c.idcontrato = l.idcontrato left join contratosadjudicatario ca on ca.idcontrato = c.idcontrato group by d.nomedistrito order by totalcontratos desc; "
-        result = execute_query(query)     
+        result = execute_query_tuples(query)     
         return result
     except Exception:
-        return []
+        return [], []
 
 
 # Generic functions for all tables
+# Lista branca de tabelas permitidas
+ALLOWED_TABLES = {
+    'CONTRATOS', 'ADJUDICANTE', 'ADJUDICATARIO', 'PAIS', 'DISTRITO',
+    'MUNICIPIO', 'CPV', 'TIPOS', 'LOCALIZACAOCONTRATOS',
+    'CONTRATOSADJUDICATARIO', 'TIPODOCONTRATO', 'CONTRATOSCPV'
+}
+
+
 def get_all_from_table(table_name, limit=100):
     """Retorna todos os registros de uma tabela (com limite).
     
     A função valida o nome da tabela para prevenir SQL injection,
     já que identificadores não podem ser parametrizados em SQLite.
     """
-    # Lista branca de tabelas permitidas
-    ALLOWED_TABLES = {
-        'CONTRATOS', 'ADJUDICANTE', 'ADJUDICATARIO', 'PAIS', 'DISTRITO',
-        'MUNICIPIO', 'CPV', 'TIPOS', 'LOCALIZACAOCONTRATOS',
-        'CONTRATOSADJUDICATARIO', 'TIPODOCONTRATO', 'CONTRATOSCPV'
-    }
-    
     # Validar se a tabela está na lista branca
     if table_name.upper() not in ALLOWED_TABLES:
         raise ValueError(f"Tabela não autorizada: {table_name}")
@@ -299,6 +444,19 @@ def get_all_from_table(table_name, limit=100):
     return execute_query(query, (limit,))
 
 
+def iter_table(table_name, limit=100):
+    """Retorna (colunas, gerador de tuplos) com os registos de uma tabela.
+
+    Usado pelas listagens genéricas, que enviam a página à medida que as
+    linhas são lidas. O nome da tabela é validado contra a lista branca.
+    """
+    if table_name.upper() not in ALLOWED_TABLES:
+        raise ValueError(f"Tabela não autorizada: {table_name}")
+
+    query = f"SELECT * FROM {table_name.upper()} LIMIT ?"
+    return iter_query(query, (limit,))
+
+
 # ADJUDICANTE functions
 def get_all_adjudicantes(limit=100):
     """Retorna todos os adjudicantes (com limite)."""
@@ -0,0 +1,318 @@
+"""
+Codificação por dicionário das colunas de texto repetitivas de CONTRATOS.
+Contratos Públicos Portugal 2024
+
+No modo codificado, cada coluna de baixa cardinalidade passa para uma tabela
+DIC_<COLUNA>(Id, Valor) e os contratos ficam em CONTRATOS_DADOS com chaves
+inteiras. Uma vista CONTRATOS, com as mesmas colunas e pela mesma ordem da
+tabela original, mantém as queries de db.py e os templates inalterados.
+Triggers INSTEAD OF na vista permitem continuar a inserir, alterar e apagar
+contratos como antes. As queries que filtram ou agrupam por uma coluna
+codificada têm em db.py uma variante sobre as chaves inteiras
+(db.execute_contratos_query), que evita descodificar cada linha.
+
+Utilização:
+    python dict_encoding.py encode [base.db]
+    python dict_encoding.py decode [base.db]
+    python dict_encoding.py report [origem.db] [destino.db]
+"""
+
+import logging
+import os
+import shutil
+import sqlite3
+import sys
+import time
+
+import db
+
+
+# Colunas candidatas à codificação
+CANDIDATE_COLUMNS = ['TipoProcedimento', 'ProcedimentoCentralizado', 'DescrAcordoQuadro', 'Fundamentacao']
+
+# Só se codifica uma coluna se tiver até esta fração de valores distintos
+MAX_DISTINCT_RATIO = 0.2
+
+DATA_TABLE = 'CONTRATOS_DADOS'
+META_TABLE = 'CODIFICACAO_META'
+
+
+def dictionary_table(column):
+    """Nome da tabela de dicionário de uma coluna."""
+    return f'DIC_{column.upper()}'
+
+
+def is_encoded(conn):
+    """Indica se CONTRATOS está no modo codificado (é uma vista)."""
+    row = conn.execute("SELECT type FROM sqlite_master WHERE name = 'CONTRATOS'").fetchone()
+    return row is not None and row[0] == 'view'
+
+
+def _select_columns(conn, columns, max_ratio):
+    """Filtra as colunas candidatas pela cardinalidade."""
+    total = conn.execute("SELECT COUNT(*) FROM CONTRATOS").fetchone()[0]
+    selected = []
+    for column in columns:
+        distinct = conn.execute(f"SELECT COUNT(DISTINCT {column}) FROM CONTRATOS").fetchone()[0]
+        if total and distinct > max_ratio * total:
+            logging.info(f'{column} não codificada: {distinct} valores distintos em {total}')
+            continue
+        logging.info(f'{column} codificada: {distinct} valores distintos em {total}')
+        selected.append(column)
+    return selected
+
+
+def _column_definitions(create_sql):
+    """Divide o corpo de um CREATE TABLE nas definições de coluna e restrições."""
+    body = create_sql[create_sql.index('(') + 1:create_sql.rindex(')')]
+    definitions, depth, current = [], 0, ''
+    for ch in body:
+        if ch == ',' and depth == 0:
+            definitions.append(current.strip())
+            current = ''
+            continue
+        depth += (ch == '(') - (ch == ')')
+        current += ch
+    if current.strip():
+        definitions.append(current.strip())
+    return definitions
+
+
+def _data_table_sql(create_sql, encoded):
+    """DDL de CONTRATOS_DADOS: a original, com as colunas codificadas trocadas por chaves.
+
+    As restantes definições são copiadas tal como estão, mantendo as
+    restrições (PRIMARY KEY, REFERENCES, NOT NULL, ...).
+    """
+    definitions = []
+    for definition in _column_definitions(create_sql):
+        name = definition.split()[0].strip('"[]`')
+        if name in encoded:
+            definitions.append(f'{name}Id INTEGER REFERENCES {dictionary_table(name)} (Id)')
+        else:
+            definitions.append(definition)
+    return f"CREATE TABLE {DATA_TABLE} (\n    " + ',\n    '.join(definitions) + '\n)'
+
+
+def _create_triggers(conn, all_columns, encoded):
+    """Cria os triggers INSTEAD OF que tornam a vista CONTRATOS atualizável."""
+    def dict_inserts(prefix):
+        return ''.join(
+            f"INSERT OR IGNORE INTO {dictionary_table(c)} (Valor) SELECT {prefix}.{c} WHERE {prefix}.{c} IS NOT NULL;\n"
+            for c in encoded)
+
+    def value_expr(c):
+        if c in encoded:
+            return f"(SELECT Id FROM {dictionary_table(c)} WHERE Valor = NEW.{c})"
+        return f"NEW.{c}"
+
+    stored_columns = ', '.join(f'{c}Id' if c in encoded else c for c in all_columns)
+    values = ', '.join(value_expr(c) for c in all_columns)
+    assignments = ', '.join(f"{c}Id = {value_expr(c)}" if c in encoded else f"{c} = NEW.{c}"
+                            for c in all_columns)
+
+    # Um execute por trigger (e não executescript, que faria COMMIT) para que
+    # os triggers sejam criados na mesma transação que a vista
+    conn.execute(f"""
+        CREATE TRIGGER CONTRATOS_INSERT INSTEAD OF INSERT ON CONTRATOS
+        BEGIN
+            {dict_inserts('NEW')}
+            INSERT INTO {DATA_TABLE} ({stored_columns}) VALUES ({values});
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER CONTRATOS_UPDATE INSTEAD OF UPDATE ON CONTRATOS
+        BEGIN
+            {dict_inserts('NEW')}
+            UPDATE {DATA_TABLE} SET {assignments} WHERE IdContrato = OLD.IdContrato;
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER CONTRATOS_DELETE INSTEAD OF DELETE ON CONTRATOS
+        BEGIN
+            DELETE FROM {DATA_TABLE} WHERE IdContrato = OLD.IdContrato;
+        END
+    """)
+
+
+def encode(conn, columns=None, max_ratio=MAX_DISTINCT_RATIO):
+    """Converte CONTRATOS para o modo codificado por dicionário.
+
+    Retorna a lista de colunas efetivamente codificadas.
+    """
+    if is_encoded(conn):
+        raise ValueError('CONTRATOS já está codificada')
+
+    encoded = _select_columns(conn, columns or CANDIDATE_COLUMNS, max_ratio)
+    if not encoded:
+        return []
+
+    table_info = conn.execute("PRAGMA table_info(CONTRATOS)").fetchall()
+    all_columns = [col[1] for col in table_info]
+    original_sql = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'CONTRATOS'").fetchone()[0]
+
+    # Subqueries escalares (e não LEFT JOINs) para que as queries que não usam
+    # uma coluna codificada não paguem a consulta ao respetivo dicionário
+    view_columns = ', '.join(f'(SELECT Valor FROM {dictionary_table(c)} WHERE Id = c.{c}Id) AS {c}'
+                             if c in encoded else f'c.{c}'
+                             for c in all_columns)
+    copy_columns = ', '.join(f'd{encoded.index(c)}.Id' if c in encoded else f'c.{c}'
+                             for c in all_columns)
+    copy_joins = ' '.join(f'LEFT JOIN {dictionary_table(c)} d{i} ON d{i}.Valor = c.{c}'
+                          for i, c in enumerate(encoded))
+
+    try:
+        conn.execute("BEGIN")
+        conn.execute(f"CREATE TABLE {META_TABLE} (Chave TEXT PRIMARY KEY, Valor TEXT)")
+        conn.execute(f"INSERT INTO {META_TABLE} VALUES ('ddl', ?)", (original_sql,))
+        conn.execute(f"INSERT INTO {META_TABLE} VALUES ('colunas', ?)", (','.join(encoded),))
+
+        for column in encoded:
+            table = dictionary_table(column)
+            conn.execute(f"CREATE TABLE {table} (Id INTEGER PRIMARY KEY, Valor TEXT UNIQUE NOT NULL)")
+            conn.execute(f"INSERT INTO {table} (Valor) SELECT DISTINCT {column} FROM CONTRATOS "
+                         f"WHERE {column} IS NOT NULL ORDER BY {column}")
+
+        conn.execute(_data_table_sql(original_sql, encoded))
+        conn.execute(f"INSERT INTO {DATA_TABLE} SELECT {copy_columns} FROM CONTRATOS c {copy_joins}")
+        for column in encoded:
+            conn.execute(f"CREATE INDEX IDX_{DATA_TABLE}_{column.upper()} ON {DATA_TABLE} ({column}Id)")
+
+        conn.execute("DROP TABLE CONTRATOS")
+        conn.execute(f"CREATE VIEW CONTRATOS AS SELECT {view_columns} FROM {DATA_TABLE} c")
+        _create_triggers(conn, all_columns, encoded)
+        conn.execute("COMMIT")
+    except sqlite3.Error:
+        conn.execute("ROLLBACK")
+        raise
+
+    logging.info(f"CONTRATOS codificada: {', '.join(encoded)}")
+    return encoded
+
+
+def decode(conn):
+    """Repõe CONTRATOS como tabela simples a partir do modo codificado."""
+    if not is_encoded(conn):
+        raise ValueError('CONTRATOS não está codificada')
+
+    meta = dict(conn.execute(f"SELECT Chave, Valor FROM {META_TABLE}").fetchall())
+    encoded = meta['colunas'].split(',')
+
+    try:
+        conn.execute("BEGIN")
+        conn.execute("CREATE TEMP TABLE CONTRATOS_TMP AS SELECT * FROM CONTRATOS")
+        conn.execute("DROP VIEW CONTRATOS")
+        conn.execute(meta['ddl'])
+        conn.execute("INSERT INTO CONTRATOS SELECT * FROM CONTRATOS_TMP")
+        conn.execute("DROP TABLE CONTRATOS_TMP")
+        conn.execute(f"DROP TABLE {DATA_TABLE}")
+        for column in encoded:
+            conn.execute(f"DROP TABLE {dictionary_table(column)}")
+        conn.execute(f"DROP TABLE {META_TABLE}")
+        conn.execute("COMMIT")
+    except sqlite3.Error:
+        conn.execute("ROLLBACK")
+        raise
+    logging.info('CONTRATOS descodificada')
+
+
+# Relatório antes/depois
+
+REPORT_QUERIES = ['get_ex1', 'get_ex2', 'get_ex4', 'get_ex11', 'get_ex12', 'get_all_contracts']
+
+
+def _table_bytes(conn, names):
+    """Bytes ocupados pelas páginas das tabelas/índices indicados (via dbstat)."""
+    try:
+        placeholders = ','.join('?' for _ in names)
+        row = conn.execute(f"SELECT SUM(pgsize) FROM dbstat WHERE name IN "
+                           f"(SELECT name FROM sqlite_master WHERE tbl_name IN ({placeholders}))",
+                           names).fetchone()
+        return row[0] or 0
+    except sqlite3.Error:
+        return None
+
+
+def _storage_stats(path):
+    conn = sqlite3.connect(path)
+    try:
+        if is_encoded(conn):
+            encoded = conn.execute(f"SELECT Valor FROM {META_TABLE} WHERE Chave = 'colunas'").fetchone()[0]
+            names = [DATA_TABLE] + [dictionary_table(c) for c in encoded.split(',')]
+        else:
+            names = ['CONTRATOS']
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+        return {
+            'file_bytes': os.path.getsize(path),
+            'db_bytes': page_size * page_count,
+            'contratos_bytes': _table_bytes(conn, names),
+        }
+    finally:
+        conn.close()
+
+
+def _time_queries(path, repeat=5):
+    """Mede o melhor tempo de cada função de REPORT_QUERIES contra a base indicada."""
+    timings = {}
+    original = db.DATABASE
+    db.DATABASE = path
+    level = logging.getLogger().level
+    logging.getLogger().setLevel(logging.WARNING)
+    try:
+        for name in REPORT_QUERIES:
+            func = getattr(db, name)
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                func()
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            timings[name] = best
+    finally:
+        db.DATABASE = original
+        logging.getLogger().setLevel(level)
+    return timings
+
+
+def report(source, target):
+    """Copia a base, codifica a cópia e compara tamanhos e tempos de query."""
+    shutil.copyfile(source, target)
+    conn = sqlite3.connect(target, isolation_level=None)
+    try:
+        encode(conn)
+        conn.execute("VACUUM")
+    finally:
+        conn.close()
+
+    before, after = _storage_stats(source), _storage_stats(target)
+    times_before, times_after = _time_queries(source), _time_queries(target)
+
+    def mib(value):
+        return 'n/d' if value is None else f'{value / 1024 / 1024:.2f} MiB'
+
+    lines = [f'{"":28}{"antes":>14}{"depois":>14}']
+    lines.append(f'{"Ficheiro":28}{mib(before["file_bytes"]):>14}{mib(after["file_bytes"]):>14}')
+    lines.append(f'{"Páginas de CONTRATOS":28}{mib(before["contratos_bytes"]):>14}{mib(after["contratos_bytes"]):>14}')
+    for name in REPORT_QUERIES:
+        lines.append(f'{name:28}{times_before[name] * 1000:>11.2f} ms{times_after[name] * 1000:>11.2f} ms')
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'report'
+    path = sys.argv[2] if len(sys.argv) > 2 else db.DATABASE
+
+    if command == 'report':
+        target = sys.argv[3] if len(sys.argv) > 3 else os.path.splitext(path)[0] + '_codificada.db'
+        print(report(path, target))
+    elif command in ('encode', 'decode'):
+        conn = sqlite3.connect(path, isolation_level=None)
+        try:
+            encode(conn) if command == 'encode' else decode(conn)
+            conn.execute("VACUUM")
+        finally:
+            conn.close()
+    else:
+        print(__doc__)
+        sys.exit(1)
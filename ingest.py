@@ -0,0 +1,509 @@
+"""
+Ingestão paralela de extratos de Contratos Públicos.
+Contratos Públicos Portugal 2024
+
+Os ficheiros (xlsx ou tsv, com as colunas descritas em
+data/raw/ContratosPublicos2024.txt) são lidos e validados num conjunto de
+processos. Um ficheiro tsv é dividido em intervalos de linhas que cada
+processo lê e valida; um ficheiro xlsx tem de ser lido sequencialmente e é
+tratado por um único processo. Cada processo devolve apenas os registos
+validados e as linhas rejeitadas, e um único escritor grava-os na base SQLite
+pela ordem dos ficheiros indicados, para que as correções se sobreponham aos
+extratos anteriores. Os cabeçalhos de todos os ficheiros são verificados
+antes de se gravar qualquer linha.
+
+Validação:
+- NIF do adjudicante (e dos adjudicatários com 9 dígitos) com dígito de controlo
+- datas de publicação e celebração
+- preço numérico e não negativo
+- códigos CPV no formato 12345678-9 e existentes na tabela CPV (se preenchida)
+
+As linhas rejeitadas ficam na tabela QUARENTENA com o motivo da rejeição.
+
+Utilização:
+    python ingest.py data/raw/ContratosPublicos2024.xlsx [outros ficheiros...]
+    python ingest.py --workers 4 --no-derived extrato_*.tsv
+    python ingest.py --batch-size 5000 extrato_grande.tsv
+"""
+
+import argparse
+import csv
+import datetime
+import io
+import json
+import logging
+import os
+import re
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import db
+
+
+SCHEMA_PATH = os.path.join(db.BASE_DIR, 'docs', 'schema.sql')
+
+QUARANTINE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS QUARENTENA (
+    IdQuarentena INTEGER PRIMARY KEY,
+    Ficheiro     VARCHAR (200),
+    Linha        INTEGER,
+    IdContrato   NUMBER (10),
+    Motivo       VARCHAR (200),
+    Dados        TEXT,
+    DataIngestao DATE
+);
+"""
+
+# Colunas obrigatórias no cabeçalho de um extrato
+COLUMNS = ('idcontrato', 'tipoContrato', 'tipoprocedimento', 'objectoContrato', 'adjudicante',
+           'adjudicatarios', 'dataPublicacao', 'dataCelebracaoContrato', 'precoContratual', 'cpv',
+           'prazoExecucao', 'localExecucao', 'fundamentacao', 'ProcedimentoCentralizado',
+           'DescrAcordoQuadro')
+
+MULTI_SEPARATOR = ' | '
+CPV_RE = re.compile(r'^\d{8}-\d$')
+
+# Linhas de um ficheiro tsv por lote enviado aos processos
+BATCH_SIZE = 2000
+
+# Lotes em curso por processo (limita a memória usada por ficheiros grandes)
+BATCHES_PER_WORKER = 2
+
+# Preenchido em cada processo pelo inicializador do pool
+_valid_cpvs = frozenset()
+
+
+# Validação (executada nos processos do pool)
+
+def nif_valido(nif):
+    """Verifica o formato e o dígito de controlo de um NIF português."""
+    if not nif or not re.fullmatch(r'\d{9}', nif):
+        return False
+    digits = [int(c) for c in nif]
+    check = 11 - sum(d * (9 - i) for i, d in enumerate(digits[:8])) % 11
+    return digits[8] == (0 if check >= 10 else check)
+
+
+def _clean(value):
+    """Normaliza células vazias ou 'NULL' para None."""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = value.strip()
+        if value in ('', 'NULL'):
+            return None
+    return value
+
+
+def _split_entity(cell):
+    """Separa 'NIF - Designação' em (NIF, designação)."""
+    nif, sep, designacao = cell.partition(' - ')
+    if not sep:
+        return None, cell.strip()
+    return nif.strip(), designacao.strip()
+
+
+def parse_date(value):
+    """Converte uma data do extrato para o formato DD/MM/AAAA usado na base."""
+    if isinstance(value, datetime.datetime):
+        value = value.date()
+    if isinstance(value, datetime.date):
+        return value.strftime('%d/%m/%Y')
+    text = str(value)
+    for fmt in ('%Y-%m-%d', '%d/%m/%Y', '%Y-%m-%d %H:%M:%S'):
+        try:
+            return datetime.datetime.strptime(text, fmt).strftime('%d/%m/%Y')
+        except ValueError:
+            continue
+    raise ValueError(f'data inválida: {text}')
+
+
+def validate_row(raw):
+    """Valida e normaliza uma linha do extrato.
+
+    Retorna o registo normalizado; lança ValueError com o motivo se for inválida.
+    """
+    row = {key: _clean(raw.get(key)) for key in COLUMNS}
+
+    try:
+        id_contrato = int(float(row['idcontrato']))
+    except (TypeError, ValueError):
+        raise ValueError(f"idcontrato inválido: {row['idcontrato']}")
+
+    if not row['adjudicante']:
+        raise ValueError('adjudicante em falta')
+    nif_adjudicante, designacao_adjudicante = _split_entity(str(row['adjudicante']))
+    if not nif_valido(nif_adjudicante):
+        raise ValueError(f'NIF do adjudicante inválido: {nif_adjudicante}')
+
+    adjudicatarios = []
+    for cell in str(row['adjudicatarios'] or '').split(MULTI_SEPARATOR):
+        if not cell.strip():
+            continue
+        nif, designacao = _split_entity(cell)
+        # NIFs estrangeiros ou anonimizados (RGPD) não seguem o formato português
+        if nif and nif.isdigit() and len(nif) == 9 and not nif_valido(nif):
+            raise ValueError(f'NIF do adjudicatário inválido: {nif}')
+        adjudicatarios.append((nif, designacao))
+
+    if row['dataPublicacao'] is None:
+        raise ValueError('data de publicação em falta')
+    data_publicacao = parse_date(row['dataPublicacao'])
+    data_celebracao = parse_date(row['dataCelebracaoContrato']) if row['dataCelebracaoContrato'] else None
+
+    try:
+        preco = float(str(row['precoContratual']).replace(',', '.'))
+    except (TypeError, ValueError):
+        raise ValueError(f"preço inválido: {row['precoContratual']}")
+    if preco < 0:
+        raise ValueError(f'preço negativo: {preco}')
+
+    cpvs = []
+    for cell in str(row['cpv'] or '').split(MULTI_SEPARATOR):
+        if not cell.strip():
+            continue
+        code, designacao = _split_entity(cell)
+        if not code or not CPV_RE.match(code):
+            raise ValueError(f'código CPV inválido: {cell}')
+        if _valid_cpvs and code not in _valid_cpvs:
+            raise ValueError(f'código CPV inexistente: {code}')
+        cpvs.append((code, designacao))
+    if not cpvs:
+        raise ValueError('CPV em falta')
+
+    localizacoes = []
+    for cell in str(row['localExecucao'] or '').split(MULTI_SEPARATOR):
+        parts = [part.strip() or None for part in cell.split(',')]
+        if parts and parts[0]:
+            localizacoes.append(tuple((parts + [None, None])[:3]))
+
+    prazo = row['prazoExecucao']
+    try:
+        prazo = int(float(prazo)) if prazo is not None else None
+    except ValueError:
+        raise ValueError(f'prazo de execução inválido: {prazo}')
+
+    return {
+        'IdContrato': id_contrato,
+        'Tipos': [t.strip() for t in str(row['tipoContrato'] or '').split(MULTI_SEPARATOR) if t.strip()],
+        'TipoProcedimento': row['tipoprocedimento'],
+        'ObjetivoContrato': row['objectoContrato'],
+        'NIFAdjudicante': int(nif_adjudicante),
+        'DesignacaoAdjudicante': designacao_adjudicante,
+        'Adjudicatarios': adjudicatarios,
+        'DataPublicacao': data_publicacao,
+        'DataCelebracaoContrato': data_celebracao,
+        'preco': preco,
+        'Cpvs': cpvs,
+        'PrazoExecucao': prazo,
+        'Localizacoes': localizacoes,
+        'Fundamentacao': row['fundamentacao'],
+        'ProcedimentoCentralizado': row['ProcedimentoCentralizado'],
+        'DescrAcordoQuadro': row['DescrAcordoQuadro'],
+    }
+
+
+def check_columns(path, header):
+    """Lança ValueError se faltarem colunas obrigatórias no cabeçalho de um extrato."""
+    missing = [column for column in COLUMNS if column not in header]
+    if missing:
+        raise ValueError(f"{path}: colunas em falta: {', '.join(missing)}")
+
+
+def _is_xlsx(path):
+    return path.lower().endswith('.xlsx')
+
+
+def _open_workbook(path):
+    try:
+        import openpyxl
+    except ImportError:
+        raise RuntimeError('A leitura de ficheiros xlsx requer o pacote openpyxl (pip install openpyxl)')
+    return openpyxl.load_workbook(path, read_only=True)
+
+
+def read_header(path):
+    """Nomes das colunas de um extrato xlsx ou tsv."""
+    if _is_xlsx(path):
+        workbook = _open_workbook(path)
+        try:
+            return [str(h).strip() for h in next(workbook.worksheets[0].iter_rows(values_only=True))]
+        finally:
+            workbook.close()
+    with open(path, newline='', encoding='utf-8') as f:
+        return [h.strip() for h in next(csv.reader(f, delimiter='\t'))]
+
+
+def read_rows(path):
+    """Lê um extrato xlsx ou tsv, gerando (número da linha, dicionário da linha)."""
+    if _is_xlsx(path):
+        workbook = _open_workbook(path)
+        try:
+            rows = workbook.worksheets[0].iter_rows(values_only=True)
+            header = [str(h).strip() for h in next(rows)]
+            check_columns(path, header)
+            for line, values in enumerate(rows, start=2):
+                if any(v is not None for v in values):
+                    yield line, dict(zip(header, values))
+        finally:
+            workbook.close()
+    else:
+        with open(path, newline='', encoding='utf-8') as f:
+            reader = csv.DictReader(f, delimiter='\t')
+            check_columns(path, reader.fieldnames or [])
+            for line, row in enumerate(reader, start=2):
+                yield line, row
+
+
+def split_tsv(path, batch_size=BATCH_SIZE):
+    """Divide um ficheiro tsv em intervalos de até batch_size linhas.
+
+    Gera (posição inicial, posição final, número da primeira linha); a
+    leitura é binária e não interpreta os campos, pelo que é rápida.
+    """
+    with open(path, 'rb') as f:
+        f.readline()
+        start, first_line, count = f.tell(), 2, 0
+        for line in iter(f.readline, b''):
+            count += 1
+            if count == batch_size:
+                yield start, f.tell(), first_line
+                start, first_line, count = f.tell(), first_line + count, 0
+        if count:
+            yield start, f.tell(), first_line
+
+
+def read_tsv_range(path, header, start, end, first_line):
+    """Lê as linhas de um tsv entre duas posições, gerando (número da linha, dicionário da linha)."""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        text = f.read(end - start).decode('utf-8')
+    reader = csv.DictReader(io.StringIO(text, newline=''), fieldnames=header, delimiter='\t')
+    for line, row in enumerate(reader, start=first_line):
+        yield line, row
+
+
+def _init_worker(valid_cpvs):
+    global _valid_cpvs
+    _valid_cpvs = valid_cpvs
+
+
+def _validate_rows(path, rows):
+    start = time.perf_counter()
+    clean, rejected = [], []
+    for line, raw in rows:
+        try:
+            clean.append(validate_row(raw))
+        except ValueError as e:
+            rejected.append((line, raw.get('idcontrato'), str(e),
+                             json.dumps(raw, default=str, ensure_ascii=False)))
+    return {'path': path, 'clean': clean, 'rejected': rejected, 'seconds': time.perf_counter() - start}
+
+
+def process_file(path):
+    """Lê e valida um ficheiro completo (executado num processo do pool)."""
+    return _validate_rows(path, read_rows(path))
+
+
+def process_range(path, header, start, end, first_line):
+    """Lê e valida um intervalo de linhas de um tsv (executado num processo do pool)."""
+    return _validate_rows(path, read_tsv_range(path, header, start, end, first_line))
+
+
+# Escrita (executada apenas no processo principal)
+
+class ContractWriter:
+    """Escritor único que grava registos validados nas tabelas normalizadas."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.lookups = {
+            'TIPOS': self._load('SELECT Tipo, ChaveTipo FROM TIPOS'),
+            'PAIS': self._load('SELECT Designacao, IdPais FROM PAIS'),
+            'DISTRITO': self._load('SELECT NomeDistrito, IdDistrito FROM DISTRITO'),
+            'MUNICIPIO': self._load('SELECT NomeMunicipio, IdMunicipio FROM MUNICIPIO'),
+        }
+        self.adjudicatarios = {(nif, designacao): chave for chave, nif, designacao
+                               in conn.execute('SELECT ChaveAdjudicatario, NIFAdjudicatario, designacao FROM ADJUDICATARIO')}
+        self.next_adjudicatario = conn.execute('SELECT IFNULL(MAX(ChaveAdjudicatario), 0) + 1 FROM ADJUDICATARIO').fetchone()[0]
+        self.next_localizacao = conn.execute('SELECT IFNULL(MAX(ChaveLocalizacao), 0) + 1 FROM LOCALIZACAOCONTRATOS').fetchone()[0]
+
+    def _load(self, query):
+        return {name: key for name, key in self.conn.execute(query)}
+
+    def _lookup(self, table, name):
+        """Retorna a chave de um valor de uma tabela de referência, criando-o se necessário."""
+        if name is None:
+            return None
+        keys = self.lookups[table]
+        if name not in keys:
+            key = max(keys.values(), default=0) + 1
+            columns = {'TIPOS': ('ChaveTipo', 'Tipo'), 'PAIS': ('IdPais', 'Designacao'),
+                       'DISTRITO': ('IdDistrito', 'NomeDistrito'), 'MUNICIPIO': ('IdMunicipio', 'NomeMunicipio')}[table]
+            self.conn.execute(f'INSERT INTO {table} ({columns[0]}, {columns[1]}) VALUES (?, ?)', (key, name))
+            keys[name] = key
+        return keys[name]
+
+    def _adjudicatario(self, nif, designacao):
+        key = (nif, designacao)
+        if key not in self.adjudicatarios:
+            self.conn.execute('INSERT INTO ADJUDICATARIO (ChaveAdjudicatario, NIFAdjudicatario, designacao) VALUES (?, ?, ?)',
+                              (self.next_adjudicatario, nif, designacao))
+            self.adjudicatarios[key] = self.next_adjudicatario
+            self.next_adjudicatario += 1
+        return self.adjudicatarios[key]
+
+    def write(self, records):
+        """Grava um lote de contratos numa única transação.
+
+        Contratos já existentes são substituídos (extratos de correção).
+        """
+        conn = self.conn
+        for r in records:
+            id_contrato = r['IdContrato']
+            if conn.execute('SELECT 1 FROM CONTRATOS WHERE IdContrato = ?', (id_contrato,)).fetchone():
+                for table in ('CONTRATOSADJUDICATARIO', 'TIPODOCONTRATO', 'CONTRATOSCPV', 'LOCALIZACAOCONTRATOS', 'CONTRATOS'):
+                    conn.execute(f'DELETE FROM {table} WHERE IdContrato = ?', (id_contrato,))
+
+            conn.execute('INSERT OR IGNORE INTO ADJUDICANTE (NIFAdjudicante, designacao) VALUES (?, ?)',
+                         (r['NIFAdjudicante'], r['DesignacaoAdjudicante']))
+            conn.execute("""
+                INSERT INTO CONTRATOS (IdContrato, TipoProcedimento, ObjetivoContrato, DataPublicacao,
+                    DataCelebracaoContrato, preco, PrazoExecucao, Fundamentacao, ProcedimentoCentralizado,
+                    DescrAcordoQuadro, NIFAdjudicante)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (id_contrato, r['TipoProcedimento'], r['ObjetivoContrato'], r['DataPublicacao'],
+                  r['DataCelebracaoContrato'], r['preco'], r['PrazoExecucao'], r['Fundamentacao'],
+                  r['ProcedimentoCentralizado'], r['DescrAcordoQuadro'], r['NIFAdjudicante']))
+
+            for tipo in set(r['Tipos']):
+                conn.execute('INSERT OR IGNORE INTO TIPODOCONTRATO (IdContrato, ChaveTipo) VALUES (?, ?)',
+                             (id_contrato, self._lookup('TIPOS', tipo)))
+            for code, designacao in r['Cpvs']:
+                conn.execute('INSERT OR IGNORE INTO CPV (CodCpv, designacao) VALUES (?, ?)', (code, designacao))
+                conn.execute('INSERT OR IGNORE INTO CONTRATOSCPV (IdContrato, CodCpv) VALUES (?, ?)', (id_contrato, code))
+            for nif, designacao in r['Adjudicatarios']:
+                conn.execute('INSERT OR IGNORE INTO CONTRATOSADJUDICATARIO (IdContrato, ChaveAdjudicatario) VALUES (?, ?)',
+                             (id_contrato, self._adjudicatario(nif, designacao)))
+            for pais, distrito, municipio in r['Localizacoes']:
+                conn.execute("""
+                    INSERT INTO LOCALIZACAOCONTRATOS (ChaveLocalizacao, IdContrato, IdPais, IdDistrito, IdMunicipio)
+                    VALUES (?, ?, ?, ?, ?)
+                """, (self.next_localizacao, id_contrato, self._lookup('PAIS', pais),
+                      self._lookup('DISTRITO', distrito), self._lookup('MUNICIPIO', municipio)))
+                self.next_localizacao += 1
+
+    def quarantine(self, path, rejected):
+        """Guarda as linhas rejeitadas de um ficheiro na tabela QUARENTENA."""
+        today = datetime.date.today().strftime('%d/%m/%Y')
+        self.conn.executemany("""
+            INSERT INTO QUARENTENA (Ficheiro, Linha, IdContrato, Motivo, Dados, DataIngestao)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, [(os.path.basename(path), line, id_contrato, motivo, dados, today)
+              for line, id_contrato, motivo, dados in rejected])
+
+
+def ensure_schema(conn):
+    """Cria as tabelas base (docs/schema.sql) e a quarentena se ainda não existirem."""
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'CONTRATOS'").fetchone()
+    if not exists:
+        with open(SCHEMA_PATH, encoding='utf-8') as f:
+            conn.executescript(f.read())
+        logging.info('Tabelas criadas a partir de docs/schema.sql')
+    conn.executescript(QUARANTINE_SCHEMA)
+    # Necessário para substituir as localizações de contratos corrigidos
+    conn.execute('CREATE INDEX IF NOT EXISTS IDX_LOCALIZACAOCONTRATOS_CONTRATO ON LOCALIZACAOCONTRATOS (IdContrato)')
+
+
+def refresh_derived(conn, changed_ids):
+    """Atualiza os índices e tabelas derivados depois de uma ingestão."""
+    import benchmarks
+    import cube
+    import similarity
+    import timeseries
+
+    similarity.update(conn, changed_ids)
+    benchmarks.build(conn)
+    timeseries.build(conn)
+    cube.build(conn)
+
+
+def ingest(paths, workers=None, derived=True, batch_size=BATCH_SIZE):
+    """Lê e valida os ficheiros em paralelo e grava-os com um único escritor.
+
+    Retorna um dicionário com o número de contratos gravados e rejeitados.
+    """
+    start = time.perf_counter()
+    workers = workers or os.cpu_count() or 1
+    conn = db.get_connection()
+    try:
+        ensure_schema(conn)
+        conn.commit()
+        valid_cpvs = frozenset(row[0] for row in conn.execute('SELECT CodCpv FROM CPV'))
+        writer = ContractWriter(conn)
+        changed_ids = set()
+        # Por ficheiro: [contratos gravados, linhas rejeitadas, segundos de leitura e validação]
+        stats = {path: [0, 0, 0.0] for path in paths}
+
+        def save(result):
+            try:
+                writer.write(result['clean'])
+                writer.quarantine(result['path'], result['rejected'])
+                conn.commit()
+            except sqlite3.Error as e:
+                logging.error(f"Erro ao gravar {result['path']}: {e}")
+                conn.rollback()
+                raise
+            file_stats = stats[result['path']]
+            file_stats[0] += len(result['clean'])
+            file_stats[1] += len(result['rejected'])
+            file_stats[2] += result['seconds']
+            changed_ids.update(r['IdContrato'] for r in result['clean'])
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(valid_cpvs,)) as pool:
+            # Um cabeçalho incompleto interrompe a ingestão antes de se gravar qualquer linha
+            headers = dict(zip(paths, pool.map(read_header, paths)))
+            for path in paths:
+                check_columns(path, headers[path])
+
+            # Os lotes são gravados pela ordem de leitura, mesmo que terminem fora de ordem
+            pending = deque()
+            for path in paths:
+                if _is_xlsx(path):
+                    tasks = [(process_file, path)]
+                else:
+                    tasks = ((process_range, path, headers[path], *bounds) for bounds in split_tsv(path, batch_size))
+                for task in tasks:
+                    pending.append(pool.submit(*task))
+                    if len(pending) >= workers * BATCHES_PER_WORKER:
+                        save(pending.popleft().result())
+            while pending:
+                save(pending.popleft().result())
+
+        for path, (clean, rejected, seconds) in stats.items():
+            logging.info(f'{path}: {clean} contratos, {rejected} rejeitados (leitura {seconds:.1f} s)')
+        written = sum(clean for clean, _, _ in stats.values())
+        rejected = sum(rejected for _, rejected, _ in stats.values())
+
+        if derived and changed_ids:
+            refresh_derived(conn, changed_ids)
+    finally:
+        db.close_connection(conn)
+
+    elapsed = time.perf_counter() - start
+    logging.info(f'Ingestão concluída: {written} contratos, {rejected} rejeitados em {elapsed:.1f} s '
+                 f'({(written + rejected) / elapsed if elapsed else 0:.0f} linhas/s)')
+    return {'written': written, 'rejected': rejected, 'seconds': elapsed}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Ingestão paralela de extratos de Contratos Públicos')
+    parser.add_argument('files', nargs='+', help='ficheiros xlsx ou tsv a ingerir, por ordem')
+    parser.add_argument('--workers', type=int, default=None, help='número de processos (por omissão, um por núcleo)')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help=f'linhas de um tsv por lote (por omissão, {BATCH_SIZE})')
+    parser.add_argument('--no-derived', action='store_true', help='não atualizar índices e tabelas derivados')
+    args = parser.parse_args()
+    ingest(args.files, workers=args.workers, derived=not args.no_derived, batch_size=args.batch_size)
@@ -0,0 +1,439 @@
+"""
+Fila de tarefas em segundo plano para relatórios pesados e exportações.
+Contratos Públicos Portugal 2024
+
+As tarefas ficam na tabela TAREFAS de uma base SQLite própria (JOBS_DATABASE),
+separada da base de dados dos contratos para que as escritas da fila não
+interfiram com as leituras nem com a versão dos dados. A execução é feita por
+um conjunto de processos trabalhadores, arrancado pelo server.py ou à parte:
+
+    python jobs.py worker --processes 2
+    python jobs.py purge
+
+Cada trabalhador assinala que está ativo na tabela TRABALHADORES, para que a
+página de uma tarefa em fila possa avisar quando nenhum está ativo. Só quando
+a última execução da mesma tarefa foi rápida (menos de INLINE_SECONDS) o
+servidor web a executa no próprio pedido.
+
+Uma tarefa igual (mesmo tipo e parâmetros) a outra pendente ou em curso não
+é duplicada, e um resultado concluído é reutilizado até expirar ou até os
+dados da base mudarem.
+"""
+
+import argparse
+import csv
+import hashlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+
+import db
+
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+JOBS_DATABASE = os.environ.get('CONTRATOS_JOBS_DB', os.path.join(BASE_DIR, 'jobs.db'))
+
+# Tempo de vida dos resultados (e das falhas), em segundos
+RESULT_TTL = 3600
+
+# Intervalo entre pesquisas de tarefas pendentes por um trabalhador
+POLL_INTERVAL = 0.5
+
+# Um trabalhador assinala que está vivo com esta periodicidade...
+HEARTBEAT_INTERVAL = 10
+
+# ...e uma tarefa em curso sem sinal há mais tempo volta à fila
+STALE_AFTER = 120
+
+# Um trabalhador sem sinal há mais tempo do que isto não conta como ativo
+WORKER_TIMEOUT = 3 * HEARTBEAT_INTERVAL
+
+# Tarefas cuja última execução demorou menos do que isto não vão para a fila
+INLINE_SECONDS = 1.0
+
+# Intervalo mínimo entre gravações de progresso
+PROGRESS_INTERVAL = 0.5
+
+PENDING, RUNNING, DONE, FAILED = 'pendente', 'em_curso', 'concluida', 'falhada'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS TAREFAS (
+    Id           VARCHAR (32) PRIMARY KEY,
+    Tipo         VARCHAR (30),
+    Parametros   TEXT,
+    Chave        VARCHAR (40),
+    Estado       VARCHAR (10),
+    Progresso    REAL,
+    Mensagem     TEXT,
+    Formato      VARCHAR (10),
+    Resultado    BLOB,
+    CriadaEm     REAL,
+    IniciadaEm   REAL,
+    AtualizadaEm REAL,
+    TerminadaEm  REAL,
+    ExpiraEm     REAL,
+    Processo     INTEGER
+);
+CREATE INDEX IF NOT EXISTS IDX_TAREFAS_CHAVE ON TAREFAS (Chave, Estado);
+CREATE INDEX IF NOT EXISTS IDX_TAREFAS_ESTADO ON TAREFAS (Estado, CriadaEm);
+
+CREATE TABLE IF NOT EXISTS TRABALHADORES (
+    Processo     INTEGER PRIMARY KEY,
+    IniciadoEm   REAL,
+    AtualizadaEm REAL
+);
+"""
+
+_schema_ready = False
+
+
+def get_connection():
+    """Abre uma conexão à base da fila, criando a tabela se necessário."""
+    global _schema_ready
+    conn = sqlite3.connect(JOBS_DATABASE, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    if not _schema_ready:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+        _schema_ready = True
+    return conn
+
+
+def _data_changed_at():
+    """Momento da última alteração da base de dados dos contratos."""
+    times = [0.0]
+    for path in (db.DATABASE, db.DATABASE + '-wal'):
+        try:
+            times.append(os.path.getmtime(path))
+        except OSError:
+            pass
+    return max(times)
+
+
+# Tipos de tarefa: cada um recebe (parâmetros, progresso) e retorna (formato, texto)
+
+def run_sql_question(params, progress):
+    """Executa uma das interrogações get_exN e guarda colunas e linhas em JSON."""
+    q = int(params['q'])
+    funcao = getattr(db, f'get_ex{q}', None)
+    if funcao is None:
+        raise ValueError(f'Pergunta inválida: {q}')
+    progress(0.0, 'A executar a consulta')
+    columns, rows = funcao()
+    # As get_exN devolvem ([], []) em caso de erro; uma consulta válida tem sempre colunas
+    if not columns:
+        raise RuntimeError(f'A consulta da pergunta {q} falhou (ver o registo do servidor)')
+    return 'json', json.dumps({'columns': list(columns), 'rows': [list(row) for row in rows]},
+                              ensure_ascii=False)
+
+
+def run_export(params, progress):
+    """Exporta uma tabela completa para CSV."""
+    table_name = str(params['table']).upper()
+    if table_name not in db.ALLOWED_TABLES:
+        raise ValueError(f'Tabela não autorizada: {table_name}')
+    total = db.execute_query(f"SELECT COUNT(*) AS n FROM {table_name}")[0]['n']
+    columns, rows = db.iter_query(f"SELECT * FROM {table_name}")
+
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(columns)
+    for count, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if count % 1000 == 0:
+            progress(count / total, f'{count} de {total} registos')
+    return 'csv', output.getvalue()
+
+
+JOB_TYPES = {
+    'sql_question': run_sql_question,
+    'export': run_export,
+}
+
+
+def _job_key(job_type, params):
+    """Chave que identifica tarefas iguais (mesmo tipo e parâmetros)."""
+    params_json = json.dumps(params, sort_keys=True)
+    return hashlib.sha1(f'{job_type}:{params_json}'.encode('utf-8')).hexdigest()
+
+
+def submit(job_type, params):
+    """Submete uma tarefa e retorna o seu id.
+
+    Se já existir uma tarefa igual pendente ou em curso, ou concluída depois
+    da última alteração dos dados e ainda não expirada, retorna o id dessa.
+    """
+    if job_type not in JOB_TYPES:
+        raise ValueError(f'Tipo de tarefa desconhecido: {job_type}')
+    params_json = json.dumps(params, sort_keys=True)
+    key = _job_key(job_type, params)
+    now = time.time()
+
+    conn = get_connection()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute("""
+            SELECT Id FROM TAREFAS
+            WHERE Chave = ?
+              AND (Estado IN (?, ?) OR (Estado = ? AND ExpiraEm > ? AND TerminadaEm >= ?))
+            ORDER BY CriadaEm DESC LIMIT 1
+        """, (key, PENDING, RUNNING, DONE, now, _data_changed_at())).fetchone()
+        if row:
+            conn.execute("COMMIT")
+            return row['Id']
+
+        job_id = uuid.uuid4().hex
+        conn.execute("""
+            INSERT INTO TAREFAS (Id, Tipo, Parametros, Chave, Estado, Progresso, CriadaEm, AtualizadaEm)
+            VALUES (?, ?, ?, ?, ?, 0, ?, ?)
+        """, (job_id, job_type, params_json, key, PENDING, now, now))
+        conn.execute("COMMIT")
+        logging.info(f'Tarefa submetida: {job_id} ({job_type} {params_json})')
+        return job_id
+    except sqlite3.Error:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+
+def workers_available():
+    """Indica se algum trabalhador deu sinal nos últimos WORKER_TIMEOUT segundos."""
+    conn = get_connection()
+    try:
+        row = conn.execute("SELECT 1 FROM TRABALHADORES WHERE AtualizadaEm > ? LIMIT 1",
+                           (time.time() - WORKER_TIMEOUT,)).fetchone()
+    finally:
+        conn.close()
+    return row is not None
+
+
+def _last_duration(conn, key):
+    """Duração, em segundos, da última execução concluída de uma tarefa igual, ou None."""
+    row = conn.execute("SELECT TerminadaEm - IniciadaEm FROM TAREFAS WHERE Chave = ? AND Estado = ? "
+                       "ORDER BY TerminadaEm DESC LIMIT 1", (key, DONE)).fetchone()
+    return row[0] if row else None
+
+
+def run(job_type, params):
+    """Submete uma tarefa e, se for sabidamente rápida, executa-a já.
+
+    A tarefa é executada neste processo apenas quando a última execução
+    igual demorou menos de INLINE_SECONDS; caso contrário fica para os
+    trabalhadores. Retorna o id da tarefa.
+    """
+    job_id = submit(job_type, params)
+    conn = get_connection()
+    try:
+        duration = _last_duration(conn, _job_key(job_type, params))
+        if duration is not None and duration < INLINE_SECONDS:
+            job = _claim(conn, job_id)
+            if job is not None:
+                _execute(conn, job)
+    finally:
+        conn.close()
+    return job_id
+
+
+def get_job(job_id):
+    """Estado de uma tarefa como dicionário (sem o resultado), ou None."""
+    conn = get_connection()
+    try:
+        row = conn.execute("""
+            SELECT Id, Tipo, Parametros, Estado, Progresso, Mensagem, Formato,
+                   CriadaEm, IniciadaEm, TerminadaEm, ExpiraEm
+            FROM TAREFAS WHERE Id = ?
+        """, (job_id,)).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return None
+    job = dict(row)
+    job['Parametros'] = json.loads(job['Parametros'])
+    return job
+
+
+def get_result(job_id):
+    """Retorna (formato, texto) do resultado de uma tarefa concluída, ou None."""
+    conn = get_connection()
+    try:
+        row = conn.execute("SELECT Formato, Resultado FROM TAREFAS WHERE Id = ? AND Estado = ? AND ExpiraEm > ?",
+                           (job_id, DONE, time.time())).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return None
+    return row['Formato'], zlib.decompress(row['Resultado']).decode('utf-8')
+
+
+def purge_expired(conn):
+    """Apaga tarefas terminadas cujo resultado expirou."""
+    deleted = conn.execute("DELETE FROM TAREFAS WHERE Estado IN (?, ?) AND ExpiraEm < ?",
+                           (DONE, FAILED, time.time())).rowcount
+    if deleted:
+        logging.info(f'Tarefas expiradas apagadas: {deleted}')
+    return deleted
+
+
+def requeue_stale(conn):
+    """Devolve à fila as tarefas cujo trabalhador deixou de dar sinal."""
+    requeued = conn.execute("UPDATE TAREFAS SET Estado = ?, Processo = NULL WHERE Estado = ? AND AtualizadaEm < ?",
+                            (PENDING, RUNNING, time.time() - STALE_AFTER)).rowcount
+    if requeued:
+        logging.warning(f'Tarefas sem sinal devolvidas à fila: {requeued}')
+
+
+def _claim(conn, job_id=None):
+    """Reserva a tarefa pendente mais antiga (ou a tarefa job_id, se pendente) para este processo."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("SELECT * FROM TAREFAS WHERE Estado = ? AND (? IS NULL OR Id = ?) ORDER BY CriadaEm LIMIT 1",
+                           (PENDING, job_id, job_id)).fetchone()
+        if row is not None:
+            now = time.time()
+            conn.execute("UPDATE TAREFAS SET Estado = ?, IniciadaEm = ?, AtualizadaEm = ?, Processo = ? WHERE Id = ?",
+                         (RUNNING, now, now, os.getpid(), row['Id']))
+        conn.execute("COMMIT")
+        return row
+    except sqlite3.Error:
+        conn.execute("ROLLBACK")
+        raise
+
+
+class _Heartbeat(threading.Thread):
+    """Atualiza periodicamente AtualizadaEm (de uma tarefa ou de um trabalhador)."""
+
+    def __init__(self, sql, params):
+        super().__init__(daemon=True)
+        self.sql = sql
+        self.params = params
+        self._stop_event = threading.Event()
+
+    def run(self):
+        conn = get_connection()
+        try:
+            while not self._stop_event.wait(HEARTBEAT_INTERVAL):
+                conn.execute(self.sql, (time.time(),) + self.params)
+        finally:
+            conn.close()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def _execute(conn, job):
+    """Executa uma tarefa reservada e grava o resultado ou o erro."""
+    last_write = [0.0]
+
+    def progress(fraction, message=None):
+        now = time.time()
+        if now - last_write[0] < PROGRESS_INTERVAL:
+            return
+        last_write[0] = now
+        conn.execute("UPDATE TAREFAS SET Progresso = ?, Mensagem = ?, AtualizadaEm = ? WHERE Id = ?",
+                     (min(max(fraction, 0.0), 1.0), message, now, job['Id']))
+
+    heartbeat = _Heartbeat("UPDATE TAREFAS SET AtualizadaEm = ? WHERE Id = ? AND Estado = ?", (job['Id'], RUNNING))
+    heartbeat.start()
+    start = time.perf_counter()
+    try:
+        result_format, text = JOB_TYPES[job['Tipo']](json.loads(job['Parametros']), progress)
+        now = time.time()
+        conn.execute("""
+            UPDATE TAREFAS SET Estado = ?, Progresso = 1, Mensagem = NULL, Formato = ?, Resultado = ?,
+                               TerminadaEm = ?, AtualizadaEm = ?, ExpiraEm = ?
+            WHERE Id = ?
+        """, (DONE, result_format, zlib.compress(text.encode('utf-8')), now, now, now + RESULT_TTL, job['Id']))
+        logging.info(f"Tarefa concluída: {job['Id']} ({time.perf_counter() - start:.2f} s)")
+    except Exception as e:
+        now = time.time()
+        conn.execute("UPDATE TAREFAS SET Estado = ?, Mensagem = ?, TerminadaEm = ?, AtualizadaEm = ?, ExpiraEm = ? "
+                     "WHERE Id = ?", (FAILED, str(e), now, now, now + RESULT_TTL, job['Id']))
+        logging.error(f"Tarefa falhada: {job['Id']}: {e}")
+    finally:
+        heartbeat.stop()
+
+
+def run_worker(max_jobs=None):
+    """Ciclo de um trabalhador: reserva e executa tarefas até ser terminado."""
+    conn = get_connection()
+    done = 0
+    last_maintenance = 0.0
+    now = time.time()
+    conn.execute("INSERT OR REPLACE INTO TRABALHADORES (Processo, IniciadoEm, AtualizadaEm) VALUES (?, ?, ?)",
+                 (os.getpid(), now, now))
+    heartbeat = _Heartbeat("UPDATE TRABALHADORES SET AtualizadaEm = ? WHERE Processo = ?", (os.getpid(),))
+    heartbeat.start()
+    try:
+        while max_jobs is None or done < max_jobs:
+            if time.time() - last_maintenance > HEARTBEAT_INTERVAL:
+                requeue_stale(conn)
+                purge_expired(conn)
+                last_maintenance = time.time()
+
+            job = _claim(conn)
+            if job is None:
+                if max_jobs is not None:
+                    break
+                time.sleep(POLL_INTERVAL)
+                continue
+            _execute(conn, job)
+            done += 1
+    finally:
+        heartbeat.stop()
+        conn.execute("DELETE FROM TRABALHADORES WHERE Processo = ?", (os.getpid(),))
+        conn.close()
+
+
+def spawn_workers(processes, daemon=False):
+    """Arranca processos trabalhadores e retorna-os sem esperar por eles."""
+    workers = [multiprocessing.Process(target=run_worker, name=f'trabalhador-{i}', daemon=daemon)
+               for i in range(processes)]
+    for worker in workers:
+        worker.start()
+    logging.info(f'{processes} trabalhadores a aguardar tarefas em {JOBS_DATABASE}')
+    return workers
+
+
+def start_workers(processes):
+    """Arranca o conjunto de processos trabalhadores e espera por eles."""
+    workers = spawn_workers(processes)
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fila de tarefas em segundo plano.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    worker_parser = subparsers.add_parser('worker', help='executa tarefas pendentes')
+    worker_parser.add_argument('--processes', type=int, default=os.cpu_count() or 1,
+                               help='número de processos trabalhadores (por omissão: número de CPUs)')
+    subparsers.add_parser('purge', help='apaga resultados expirados')
+    args = parser.parse_args()
+
+    if args.command == 'worker':
+        start_workers(max(args.processes, 1))
+    else:
+        conn = get_connection()
+        try:
+            purge_expired(conn)
+        finally:
+            conn.close()
+
+
+if __name__ == '__main__':
+    main()
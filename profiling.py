@@ -0,0 +1,231 @@
+"""
+Perfilagem opcional de pedidos HTTP.
+Contratos Públicos Portugal 2024
+
+Quando ativa, cada pedido perfilado gera três ficheiros em PROFILING_DIR:
+- <id>.prof   - estatísticas cProfile (abrir com pstats ou snakeviz)
+- <id>.folded - pilhas colapsadas por amostragem (prontas para flamegraph.pl / speedscope)
+- <id>.json   - metadados do pedido (rota, parâmetros, estado, duração)
+
+Configuração (app.config ou variáveis de ambiente com o mesmo nome):
+- PROFILING_ENABLED      - ativa o mecanismo (por omissão desligado)
+- PROFILING_SAMPLE_RATE  - fração de pedidos perfilados sem cabeçalho (0.0 a 1.0)
+- PROFILING_HEADER       - cabeçalho que força a perfilagem de um pedido
+- PROFILING_TOKEN        - valor secreto que o cabeçalho tem de trazer (sem ele, o cabeçalho é ignorado)
+- PROFILING_MAX_PROFILES - número máximo de perfis guardados; os mais antigos são apagados
+- PROFILING_INTERVAL     - intervalo de amostragem das pilhas, em segundos
+- PROFILING_DIR          - diretório de saída
+"""
+
+import cProfile
+import hmac
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+
+from flask import g, request
+
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULTS = {
+    'PROFILING_ENABLED': False,
+    'PROFILING_SAMPLE_RATE': 0.0,
+    'PROFILING_HEADER': 'X-Profile',
+    'PROFILING_TOKEN': '',
+    'PROFILING_MAX_PROFILES': 200,
+    'PROFILING_INTERVAL': 0.005,
+    'PROFILING_DIR': os.path.join(BASE_DIR, 'profiles'),
+}
+
+# Apenas um pedido é perfilado de cada vez: o cProfile não suporta
+# vários perfis ativos em simultâneo e isto limita o custo em produção.
+_profile_lock = threading.Lock()
+
+
+def _env_value(name, default):
+    """Lê uma opção do ambiente, convertendo para o tipo do valor por omissão."""
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    if isinstance(default, bool):
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    if isinstance(default, (int, float)):
+        try:
+            return type(default)(value)
+        except ValueError:
+            logging.warning(f'Valor inválido para {name}: {value}')
+            return default
+    return value
+
+
+class StackSampler(threading.Thread):
+    """Amostra periodicamente a pilha de uma thread e agrega pilhas colapsadas."""
+
+    def __init__(self, target_thread_id, interval):
+        super().__init__(daemon=True)
+        self.target_thread_id = target_thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.target_thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def collapsed(self):
+        """Devolve as pilhas no formato 'f1;f2;f3 contagem', uma por linha."""
+        return '\n'.join(f'{stack} {count}' for stack, count in self.stacks.most_common())
+
+
+def _should_profile(app):
+    """Decide se o pedido atual deve ser perfilado."""
+    # O cabeçalho só força a perfilagem se trouxer o segredo configurado
+    value = request.headers.get(app.config['PROFILING_HEADER'])
+    token = app.config['PROFILING_TOKEN']
+    if value and token and hmac.compare_digest(value.encode('utf-8'), token.encode('utf-8')):
+        return True
+    rate = app.config['PROFILING_SAMPLE_RATE']
+    return rate > 0 and random.random() < rate
+
+
+def _start_profiling(app):
+    if not _should_profile(app):
+        return
+    if not _profile_lock.acquire(blocking=False):
+        logging.info('Perfilagem ignorada: outro pedido já está a ser perfilado')
+        return
+
+    profiler = cProfile.Profile()
+    sampler = StackSampler(threading.get_ident(), app.config['PROFILING_INTERVAL'])
+    g._profiling = {
+        'id': f"{time.strftime('%Y%m%d-%H%M%S')}_{request.endpoint or 'unknown'}_{uuid.uuid4().hex[:8]}",
+        'profiler': profiler,
+        'sampler': sampler,
+        'start': time.perf_counter(),
+        'started_at': time.time(),
+    }
+    sampler.start()
+    profiler.enable()
+
+
+def _prune_profiles(output_dir, max_profiles):
+    """Apaga os perfis mais antigos para manter no máximo max_profiles."""
+    profiles = {}
+    for name in os.listdir(output_dir):
+        base, extension = os.path.splitext(name)
+        if extension in ('.prof', '.folded', '.json'):
+            path = os.path.join(output_dir, name)
+            profiles[base] = max(profiles.get(base, 0), os.path.getmtime(path))
+    for base in sorted(profiles, key=profiles.get)[:max(len(profiles) - max_profiles, 0)]:
+        for extension in ('.prof', '.folded', '.json'):
+            try:
+                os.remove(os.path.join(output_dir, base + extension))
+            except FileNotFoundError:
+                pass
+
+
+def _finish_profiling(app, state, status_code):
+    """Pára a perfilagem e grava os ficheiros do pedido."""
+    try:
+        state['profiler'].disable()
+        state['sampler'].stop()
+        duration = time.perf_counter() - state['start']
+
+        output_dir = app.config['PROFILING_DIR']
+        os.makedirs(output_dir, exist_ok=True)
+        base_path = os.path.join(output_dir, state['id'])
+
+        state['profiler'].dump_stats(base_path + '.prof')
+        with open(base_path + '.folded', 'w', encoding='utf-8') as f:
+            f.write(state['sampler'].collapsed())
+        with open(base_path + '.json', 'w', encoding='utf-8') as f:
+            json.dump({**state['metadata'],
+                       'status': status_code,
+                       'duration_ms': round(duration * 1000, 3),
+                       'samples': sum(state['sampler'].stacks.values()),
+                       'started_at': state['started_at']},
+                      f, ensure_ascii=False, indent=2)
+        logging.info(f"Perfil gravado: {base_path} ({duration * 1000:.1f} ms)")
+        _prune_profiles(output_dir, app.config['PROFILING_MAX_PROFILES'])
+    except OSError as e:
+        logging.error(f'Erro ao gravar perfil: {e}')
+    finally:
+        _profile_lock.release()
+
+
+def _finish_after_body(app, state, body, status_code):
+    """Envolve o corpo de uma resposta em streaming e grava o perfil no fim."""
+    try:
+        yield from body
+    finally:
+        _finish_profiling(app, state, status_code)
+
+
+def _stop_profiling(app, response):
+    state = g.pop('_profiling', None)
+    if state is None:
+        return response
+
+    # Os metadados são lidos agora, enquanto o contexto do pedido existe
+    state['metadata'] = {
+        'id': state['id'],
+        'method': request.method,
+        'path': request.path,
+        'route': request.url_rule.rule if request.url_rule else None,
+        'endpoint': request.endpoint,
+        'view_args': request.view_args,
+        'args': request.args.to_dict(flat=False),
+    }
+    response.headers['X-Profile-Id'] = state['id']
+
+    # Respostas em streaming só terminam depois de o corpo ser consumido
+    if response.is_streamed:
+        response.response = _finish_after_body(app, state, response.response, response.status_code)
+    else:
+        _finish_profiling(app, state, response.status_code)
+    return response
+
+
+def _abort_profiling(exc):
+    # Garante que o lock é libertado se o pedido falhar antes do after_request
+    state = g.pop('_profiling', None)
+    if state is not None:
+        state['profiler'].disable()
+        state['sampler'].stop()
+        _profile_lock.release()
+
+
+def init_profiling(app):
+    """Regista os hooks de perfilagem na aplicação Flask, se ativa."""
+    for name, default in DEFAULTS.items():
+        app.config.setdefault(name, _env_value(name, default))
+
+    if not app.config['PROFILING_ENABLED']:
+        return
+
+    app.before_request(lambda: _start_profiling(app))
+    app.after_request(lambda response: _stop_profiling(app, response))
+    app.teardown_request(_abort_profiling)
+    if not app.config['PROFILING_TOKEN']:
+        logging.warning(f"PROFILING_TOKEN não definido: o cabeçalho {app.config['PROFILING_HEADER']} é ignorado")
+    logging.info(f"Perfilagem ativa (amostragem {app.config['PROFILING_SAMPLE_RATE']:.2%}, "
+                 f"cabeçalho {app.config['PROFILING_HEADER']})")
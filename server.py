@@ -4,6 +4,9 @@ Ponto de entrada da aplicação.
 """
 
 import logging
+import os
+
+import jobs
 from app import app
 
 # Configuração de logging
@@ -12,6 +15,15 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
+# Trabalhadores da fila de tarefas arrancados com o servidor (0 se correrem à parte)
+JOBS_WORKERS = int(os.environ.get('JOBS_WORKERS', '2'))
+
 if __name__ == '__main__':
     logging.info('Iniciando servidor...')
-    app.run(host='0.0.0.0', port=9001, debug=False)
+    # Os relatórios pesados e as exportações correm nestes processos, nunca no pedido
+    workers = jobs.spawn_workers(JOBS_WORKERS, daemon=True)
+    try:
+        app.run(host='0.0.0.0', port=9001, debug=False)
+    finally:
+        for worker in workers:
+            worker.terminate()
@@ -0,0 +1,277 @@
+"""
+Índice TF-IDF esparso para recomendar contratos semelhantes.
+Contratos Públicos Portugal 2024
+
+O índice é construído offline a partir de ObjetivoContrato e dos códigos CPV
+de cada contrato e gravado num único ficheiro binário. Os processos web
+abrem-no com mmap (sem o carregar para memória) e voltam a abri-lo quando o
+ficheiro é substituído, pelo que uma reconstrução não obriga a reiniciar o
+servidor.
+
+Utilização:
+    python similarity.py build    # reconstrução completa
+    python similarity.py update   # apenas contratos novos ou removidos
+"""
+
+import heapq
+import logging
+import math
+import mmap
+import os
+import struct
+import sys
+import threading
+from array import array
+from bisect import bisect_left
+from collections import Counter, defaultdict
+
+import db
+from text_utils import tokenize
+
+
+def index_path():
+    """Caminho do índice: SIMILARITY_INDEX, ou junto da base de dados atual.
+
+    Derivado de db.DATABASE no momento da chamada, para que uma ingestão
+    noutra base (CONTRATOS_DB) não substitua o índice da base principal.
+    """
+    return os.environ.get('SIMILARITY_INDEX') or os.path.splitext(db.DATABASE)[0] + '.similar.idx'
+
+
+# Número máximo de entradas lidas por termo numa consulta. As listas estão
+# ordenadas por peso, logo o corte só descarta os contributos mais pequenos.
+MAX_POSTINGS_PER_TERM = 2000
+
+MAGIC = b'TFIDF001'
+# magic, n_docs, n_terms e os offsets das 9 secções do ficheiro
+HEADER = struct.Struct('<8sII9Q')
+SECTIONS = ('doc_ids', 'doc_offsets', 'doc_terms', 'doc_tf', 'doc_weights',
+            'post_offsets', 'post_docs', 'post_weights', 'vocab')
+TYPECODES = {'doc_ids': 'q', 'doc_offsets': 'I', 'doc_terms': 'I', 'doc_tf': 'H',
+             'doc_weights': 'f', 'post_offsets': 'I', 'post_docs': 'I', 'post_weights': 'f'}
+
+
+def contract_terms(description, cpv_codes):
+    """Termos de um contrato: palavras do objeto e códigos CPV (completo e grupo)."""
+    terms = Counter(tokenize(description))
+    for code in cpv_codes:
+        digits = str(code).split('-')[0]
+        terms[f'cpv:{digits}'] += 1
+        terms[f'cpvg:{digits[:3]}'] += 1
+    return terms
+
+
+def _fetch_documents(conn, ids=None):
+    """Lê e tokeniza os contratos indicados (ou todos) da base de dados."""
+    where, params = '', ()
+    if ids is not None:
+        ids = list(ids)
+        if not ids:
+            return {}
+        where = f" WHERE IdContrato IN ({','.join('?' for _ in ids)})"
+        params = tuple(ids)
+
+    cpvs = defaultdict(list)
+    for id_contrato, cod_cpv in conn.execute(f"SELECT IdContrato, CodCpv FROM CONTRATOSCPV{where}", params):
+        cpvs[id_contrato].append(cod_cpv)
+
+    return {id_contrato: contract_terms(description, cpvs.get(id_contrato, ()))
+            for id_contrato, description
+            in conn.execute(f"SELECT IdContrato, ObjetivoContrato FROM CONTRATOS{where}", params)}
+
+
+def _write_index(path, documents):
+    """Calcula os pesos TF-IDF e grava o índice de forma atómica."""
+    doc_ids = sorted(documents)
+    vocabulary = sorted({term for terms in documents.values() for term in terms})
+    term_index = {term: i for i, term in enumerate(vocabulary)}
+
+    df = Counter()
+    for terms in documents.values():
+        df.update(terms.keys())
+    n_docs = len(doc_ids)
+    idf = {term: math.log((1 + n_docs) / (1 + df[term])) + 1 for term in vocabulary}
+
+    data = {name: array(code) for name, code in TYPECODES.items()}
+    data['doc_ids'].extend(doc_ids)
+    data['doc_offsets'].append(0)
+    postings = defaultdict(list)
+
+    for doc_index, id_contrato in enumerate(doc_ids):
+        terms = documents[id_contrato]
+        # Ordem fixa dos termos: o índice atualizado fica igual ao reconstruído
+        ordered = sorted(terms, key=term_index.get)
+        weights = {term: (1 + math.log(terms[term])) * idf[term] for term in ordered}
+        norm = math.sqrt(sum(w * w for w in weights.values())) or 1.0
+        for term in ordered:
+            weight = weights[term] / norm
+            data['doc_terms'].append(term_index[term])
+            data['doc_tf'].append(min(terms[term], 0xFFFF))
+            data['doc_weights'].append(weight)
+            postings[term_index[term]].append((weight, doc_index))
+        data['doc_offsets'].append(len(data['doc_terms']))
+
+    data['post_offsets'].append(0)
+    for term_id in range(len(vocabulary)):
+        for weight, doc_index in sorted(postings[term_id], reverse=True):
+            data['post_docs'].append(doc_index)
+            data['post_weights'].append(weight)
+        data['post_offsets'].append(len(data['post_docs']))
+
+    blobs = [data[name].tobytes() for name in SECTIONS[:-1]] + ['\n'.join(vocabulary).encode('utf-8')]
+    offsets, position = [], HEADER.size
+    for blob in blobs:
+        position += -position % 8  # secções alinhadas a 8 bytes
+        offsets.append(position)
+        position += len(blob)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, n_docs, len(vocabulary), *offsets))
+        for offset, blob in zip(offsets, blobs):
+            f.write(b'\0' * (offset - f.tell()))
+            f.write(blob)
+    os.replace(tmp_path, path)
+    logging.info(f'Índice de semelhança gravado: {n_docs} contratos, {len(vocabulary)} termos')
+
+
+class SimilarityIndex:
+    """Índice TF-IDF aberto por mmap, apenas para leitura."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.n_docs, self.n_terms, *offsets = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise ValueError(f'Ficheiro de índice inválido: {path}')
+
+        view = memoryview(self._mmap)
+        ends = offsets[1:] + [len(self._mmap)]
+        for name, start, end in zip(SECTIONS, offsets, ends):
+            if name == 'vocab':
+                self._vocab_bytes = view[start:end]
+                continue
+            size = array(TYPECODES[name]).itemsize
+            length = (end - start) // size
+            setattr(self, name, view[start:start + length * size].cast(TYPECODES[name]))
+        # doc_offsets e post_offsets têm exatamente n + 1 entradas
+        self.doc_offsets = self.doc_offsets[:self.n_docs + 1]
+        self.post_offsets = self.post_offsets[:self.n_terms + 1]
+        self.doc_ids = self.doc_ids[:self.n_docs]
+
+    def _doc_index(self, id_contrato):
+        i = bisect_left(self.doc_ids, id_contrato)
+        if i < self.n_docs and self.doc_ids[i] == id_contrato:
+            return i
+        return None
+
+    def similar(self, id_contrato, k=10):
+        """Retorna até k pares (IdContrato, semelhança) por ordem decrescente."""
+        doc_index = self._doc_index(id_contrato)
+        if doc_index is None:
+            return []
+
+        scores = defaultdict(float)
+        start, end = self.doc_offsets[doc_index], self.doc_offsets[doc_index + 1]
+        for term_id, query_weight in zip(self.doc_terms[start:end], self.doc_weights[start:end]):
+            p_start, p_end = self.post_offsets[term_id], self.post_offsets[term_id + 1]
+            p_end = min(p_end, p_start + MAX_POSTINGS_PER_TERM)
+            for other, weight in zip(self.post_docs[p_start:p_end], self.post_weights[p_start:p_end]):
+                scores[other] += query_weight * weight
+
+        scores.pop(doc_index, None)
+        best = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+        return [(self.doc_ids[i], score) for i, score in best]
+
+    def documents(self):
+        """Reconstrói as frequências de termos por contrato (para atualizações)."""
+        vocabulary = bytes(self._vocab_bytes).decode('utf-8').split('\n')
+        documents = {}
+        for doc_index, id_contrato in enumerate(self.doc_ids):
+            start, end = self.doc_offsets[doc_index], self.doc_offsets[doc_index + 1]
+            documents[id_contrato] = Counter({vocabulary[t]: tf for t, tf
+                                              in zip(self.doc_terms[start:end], self.doc_tf[start:end])})
+        return documents
+
+    def close(self):
+        for name in SECTIONS:
+            attr = '_vocab_bytes' if name == 'vocab' else name
+            getattr(self, attr).release()
+        self._mmap.close()
+
+
+def build(conn, path=None):
+    """Reconstrói o índice completo a partir da base de dados."""
+    _write_index(path or index_path(), _fetch_documents(conn))
+
+
+def update(conn, changed_ids=(), path=None):
+    """Atualiza o índice com contratos novos, alterados ou removidos.
+
+    Só os contratos novos ou em changed_ids são lidos e tokenizados; os pesos
+    TF-IDF são recalculados para todos, já que dependem das frequências globais.
+    """
+    path = path or index_path()
+    if not os.path.exists(path):
+        build(conn, path)
+        return
+
+    index = SimilarityIndex(path)
+    try:
+        documents = index.documents()
+    finally:
+        index.close()
+
+    current_ids = {row[0] for row in conn.execute("SELECT IdContrato FROM CONTRATOS")}
+    for id_contrato in set(documents) - current_ids:
+        del documents[id_contrato]
+    to_fetch = (current_ids - set(documents)) | (set(changed_ids) & current_ids)
+    documents.update(_fetch_documents(conn, to_fetch))
+    logging.info(f'Índice de semelhança: {len(to_fetch)} contratos novos ou alterados')
+    _write_index(path, documents)
+
+
+# Índice partilhado pelo processo web, reaberto quando o ficheiro muda
+_index = None
+_index_stat = None
+_index_lock = threading.Lock()
+
+
+def get_index(path=None):
+    """Retorna o índice aberto, ou None se ainda não tiver sido construído."""
+    global _index, _index_stat
+    path = path or index_path()
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    key = (path, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    with _index_lock:
+        if key != _index_stat:
+            # O índice antigo não é fechado: pode estar a ser usado por outro pedido
+            _index = SimilarityIndex(path)
+            _index_stat = key
+        return _index
+
+
+def get_similar_contracts(id_contrato, k=10):
+    """Retorna até k pares (IdContrato, semelhança) para um contrato."""
+    index = get_index()
+    if index is None:
+        return []
+    return index.similar(id_contrato, k)
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'build'
+    conn = db.get_connection()
+    try:
+        if command == 'build':
+            build(conn)
+        elif command == 'update':
+            update(conn)
+        else:
+            print(__doc__)
+            sys.exit(1)
+    finally:
+        db.close_connection(conn)
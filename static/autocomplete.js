@@ -0,0 +1,87 @@
+// Sugestões de adjudicantes e adjudicatários nas caixas com data-autocomplete
+(function () {
+    var DELAY_MS = 80;
+    var TIPOS = { adjudicante: 'Adjudicante', adjudicatario: 'Adjudicatário' };
+
+    function attach(input) {
+        var list = document.createElement('ul');
+        list.className = 'autocomplete-list';
+        list.hidden = true;
+        input.parentNode.classList.add('autocomplete');
+        input.parentNode.appendChild(list);
+        input.setAttribute('autocomplete', 'off');
+
+        var timer = null;
+        var pending = null;
+        var active = -1;
+
+        function close() {
+            list.hidden = true;
+            list.innerHTML = '';
+            active = -1;
+        }
+
+        function highlight(index) {
+            var items = list.children;
+            if (!items.length) return;
+            active = (index + items.length) % items.length;
+            for (var i = 0; i < items.length; i++) {
+                items[i].classList.toggle('active', i === active);
+            }
+        }
+
+        function render(sugestoes) {
+            close();
+            sugestoes.forEach(function (s) {
+                var item = document.createElement('li');
+                var link = document.createElement('a');
+                link.href = s.url;
+                link.textContent = s.designacao;
+                var info = document.createElement('small');
+                info.textContent = TIPOS[s.tipo] + (s.nif ? ' · NIF ' + s.nif : '') + ' · ' + s.contratos + ' contratos';
+                link.appendChild(info);
+                item.appendChild(link);
+                list.appendChild(item);
+            });
+            list.hidden = !sugestoes.length;
+        }
+
+        function fetchSuggestions() {
+            if (pending) pending.abort();
+            pending = new AbortController();
+            fetch(input.dataset.autocomplete + '?q=' + encodeURIComponent(input.value), { signal: pending.signal })
+                .then(function (response) { return response.json(); })
+                .then(render)
+                .catch(function () {});
+        }
+
+        input.addEventListener('input', function () {
+            clearTimeout(timer);
+            if (input.value.trim().length < 2) {
+                close();
+                return;
+            }
+            timer = setTimeout(fetchSuggestions, DELAY_MS);
+        });
+
+        input.addEventListener('keydown', function (event) {
+            if (list.hidden) return;
+            if (event.key === 'ArrowDown' || event.key === 'ArrowUp') {
+                event.preventDefault();
+                highlight(active + (event.key === 'ArrowDown' ? 1 : -1));
+            } else if (event.key === 'Enter' && active >= 0) {
+                event.preventDefault();
+                window.location = list.children[active].firstChild.href;
+            } else if (event.key === 'Escape') {
+                close();
+            }
+        });
+
+        input.addEventListener('blur', function () {
+            // Deixa o clique numa sugestão chegar à ligação antes de fechar
+            setTimeout(close, 150);
+        });
+    }
+
+    document.querySelectorAll('input[data-autocomplete]').forEach(attach);
+})();
@@ -0,0 +1,69 @@
+"""
+Testes do índice de prefixos de autocomplete.py.
+"""
+
+import autocomplete
+from autocomplete import PrefixIndex
+
+
+ENTITIES = [
+    ('adjudicante', 1, '600000001', 'Administração Regional de Saúde', 120),
+    ('adjudicante', 2, '508142156', 'Saúde Norte, E. P. E.', 5),
+    ('adjudicatario', 3, '500000000', 'Fornecedora de Material Hospitalar, Lda', 40),
+    ('adjudicatario', 4, '', 'Lusa Limpezas, Lda', 2),
+]
+
+
+def _names(results):
+    return [designacao for _, _, _, designacao, _ in results]
+
+
+def test_palavra_a_meio_sem_acentos():
+    """'saude' e 'Saúde' encontram uma palavra a meio do nome."""
+    index = PrefixIndex(ENTITIES)
+    for text in ('saude', 'Saúde', 'SAU'):
+        assert 'Administração Regional de Saúde' in _names(index.search(text))
+    assert _names(index.search('regional de s')) == ['Administração Regional de Saúde']
+
+
+def test_prefixo_nif():
+    """Um prefixo de NIF encontra a entidade; NIFs vazios não são indexados."""
+    index = PrefixIndex(ENTITIES)
+    assert _names(index.search('5081')) == ['Saúde Norte, E. P. E.']
+    assert _names(index.search('50')) == ['Fornecedora de Material Hospitalar, Lda', 'Saúde Norte, E. P. E.']
+
+
+def test_stopwords_nao_indexadas():
+    """Palavras como 'de' a meio do nome não geram chaves."""
+    index = PrefixIndex(ENTITIES)
+    assert not any(key.startswith('de ') or key == 'de' for key in index.keys)
+    assert index.search('de') == []
+
+
+def test_consulta_curta():
+    """Textos com menos de MIN_QUERY_LENGTH caracteres não devolvem nada."""
+    assert PrefixIndex(ENTITIES).search('s') == []
+
+
+def test_inicio_do_nome_primeiro():
+    """Uma correspondência no início do nome vem antes de uma a meio, mesmo com menos contratos."""
+    index = PrefixIndex(ENTITIES)
+    assert _names(index.search('saude')) == ['Saúde Norte, E. P. E.', 'Administração Regional de Saúde']
+    # Entre correspondências a meio, ganha quem tem mais contratos
+    assert _names(index.search('lda')) == ['Fornecedora de Material Hospitalar, Lda', 'Lusa Limpezas, Lda']
+
+
+def test_prefixo_com_muitas_chaves(monkeypatch):
+    """Um prefixo com mais de MAX_SCAN chaves usa as melhores entidades pré-calculadas,
+    e não as primeiras por ordem alfabética."""
+    monkeypatch.setattr(autocomplete, 'MAX_SCAN', 3)
+    entities = [('adjudicatario', i, '', f'Ab{letter} Lda', i) for i, letter in enumerate('abcdef')]
+    entities.append(('adjudicante', 99, '', 'Abz Saúde', 1000))
+    index = PrefixIndex(entities)
+
+    assert 'ab' in index.top
+    assert index.search('ab', 3) == [index.entities[number] for number in index.top['ab'][:3]]
+    assert _names(index.search('ab', 3)) == ['Abz Saúde', 'Abf Lda', 'Abe Lda']
+    # Prefixos com poucas chaves continuam a ser lidos diretamente
+    assert 'abz' not in index.top
+    assert _names(index.search('abz')) == ['Abz Saúde']
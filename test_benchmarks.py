@@ -0,0 +1,53 @@
+"""
+Testes das funções de quantis e percentis de benchmarks.py.
+"""
+
+from benchmarks import percent_rank, quantile
+
+
+def test_quantile_um_elemento():
+    """Com um só preço, todos os quantis são esse preço."""
+    for q in (0, 0.1, 0.5, 0.9, 1):
+        assert quantile([42.0], q) == 42.0
+
+
+def test_quantile_extremos():
+    """q = 0 e q = 1 devolvem o mínimo e o máximo."""
+    values = [1.0, 2.0, 5.0, 10.0]
+    assert quantile(values, 0) == 1.0
+    assert quantile(values, 1) == 10.0
+
+
+def test_quantile_interpolacao():
+    """Entre dois pontos o quantil é interpolado linearmente."""
+    values = [10.0, 20.0, 30.0, 40.0]
+    assert quantile(values, 0.5) == 25.0
+    assert quantile(values, 0.25) == 17.5
+
+
+def test_quantile_empates():
+    """Valores repetidos não alteram os quantis que caem sobre eles."""
+    values = [5.0, 5.0, 5.0, 5.0, 9.0]
+    assert quantile(values, 0.25) == 5.0
+    assert quantile(values, 0.75) == 5.0
+    assert quantile(values, 1) == 9.0
+
+
+def test_percent_rank_um_elemento():
+    """Num grupo de um só preço, esse preço fica no percentil 50."""
+    assert percent_rank([7.0], 7.0) == 50.0
+
+
+def test_percent_rank_empates():
+    """Os empates contam metade."""
+    values = [1.0, 2.0, 2.0, 2.0, 3.0]
+    assert percent_rank(values, 2.0) == 100.0 * (1 + 1.5) / 5
+    assert percent_rank([4.0, 4.0, 4.0], 4.0) == 50.0
+
+
+def test_percent_rank_extremos():
+    """Preços abaixo do mínimo ou acima do máximo ficam em 0 e 100."""
+    values = [1.0, 2.0, 3.0]
+    assert percent_rank(values, 0.5) == 0.0
+    assert percent_rank(values, 10.0) == 100.0
+    assert percent_rank(values, 1.0) == 100.0 * 0.5 / 3
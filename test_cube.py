@@ -0,0 +1,77 @@
+"""
+Testes das chaves e níveis do cubo (cube.py) usados para detalhar e agregar.
+"""
+
+import sqlite3
+
+import pytest
+
+import cube
+import db
+
+
+def test_key_level():
+    """O nível de uma chave vem do número de partes do caminho ou dígitos do CPV."""
+    assert cube.key_level('geo', '') == 0
+    assert cube.key_level('geo', '1') == 1
+    assert cube.key_level('geo', '1/13') == 2
+    assert cube.key_level('geo', '1/13/1312') == 3
+    assert cube.key_level('cpv', None) == 0
+    assert cube.key_level('cpv', '33') == 1
+    assert cube.key_level('cpv', '33141') == 4
+    assert cube.key_level('procedimento', 'Ajuste Direto Regime Geral') == 1
+    assert cube.key_level('mes', '2024-03') == 1
+
+
+def test_key_level_cpv_invalido():
+    """Um prefixo CPV com um número de dígitos que não é um nível lança ValueError."""
+    with pytest.raises(ValueError):
+        cube.key_level('cpv', '331416')
+
+
+def test_parent_key():
+    """Subir um nível corta a última parte da chave; do primeiro nível sobe-se para "todos"."""
+    assert cube.parent_key('geo', '1/13/1312') == '1/13'
+    assert cube.parent_key('geo', '1/13') == '1'
+    assert cube.parent_key('geo', '1') == ''
+    assert cube.parent_key('cpv', '33141') == '3314'
+    assert cube.parent_key('cpv', '331') == '33'
+    assert cube.parent_key('cpv', '33') == ''
+    assert cube.parent_key('mes', '2024-03') == ''
+
+
+def test_child_level():
+    """O detalhe fica um nível abaixo do filtro, sem passar do nível mais fino."""
+    assert cube.child_level('geo', {}) == 1
+    assert cube.child_level('geo', {'geo': '1/13'}) == 3
+    assert cube.child_level('geo', {'geo': '1/13/1312'}) == 3
+    assert cube.child_level('cpv', {'cpv': '3314'}) == 4
+    assert cube.child_level('mes', {'mes': '2024-03'}) == 1
+
+
+@pytest.fixture
+def cubo(tmp_path, monkeypatch):
+    """Base temporária com algumas células de município do cubo."""
+    path = tmp_path / 'cubo.db'
+    conn = sqlite3.connect(path)
+    conn.executescript(cube.SCHEMA)
+    conn.executemany("INSERT INTO CUBO VALUES (3, ?, 0, '', 0, '', 0, '', 1, 10.0)",
+                     [('1/1/101',), ('1/1/102',), ('1/10/1001',), ('1/11/1101',), ('2/1/201',)])
+    conn.commit()
+    conn.close()
+    monkeypatch.setattr(db, 'DATABASE', str(path))
+
+
+def test_query_filtro_geo(cubo):
+    """O filtro '1/1' inclui os municípios do distrito 1 e não os dos distritos 10 ou 11."""
+    rows = cube.query({'geo': 3}, {'geo': '1/1'})
+    assert sorted(row['Geo'] for row in rows) == ['1/1/101', '1/1/102']
+    rows = cube.query({'geo': 3}, {'geo': '1'})
+    assert sorted(row['Geo'] for row in rows) == ['1/1/101', '1/1/102', '1/10/1001', '1/11/1101']
+
+
+def test_query_sem_cubo(tmp_path, monkeypatch):
+    """Sem a tabela CUBO a consulta devolve uma tabela vazia em vez de falhar."""
+    monkeypatch.setattr(db, 'DATABASE', str(tmp_path / 'vazia.db'))
+    assert cube.query({'geo': 1}, {}) == []
+    assert cube.pivot('geo', 'mes', {})['total'] == (0, 0.0)
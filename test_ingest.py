@@ -0,0 +1,141 @@
+"""
+Testes das funções de validação de ingest.py.
+"""
+
+import datetime
+
+import pytest
+
+from ingest import check_columns, nif_valido, parse_date, read_rows, read_tsv_range, split_tsv, validate_row
+
+
+def _row(**changes):
+    """Linha válida de um extrato, com as alterações indicadas."""
+    row = {
+        'idcontrato': '10939999',
+        'tipoContrato': 'Aquisição de bens móveis',
+        'tipoprocedimento': 'Ajuste Direto Regime Geral',
+        'objectoContrato': 'Material de escritório',
+        'adjudicante': '508142156 - Unidade Local de Saúde',
+        'adjudicatarios': '500000000 - Fornecedor, Lda',
+        'dataPublicacao': '2024-03-01',
+        'dataCelebracaoContrato': '2024-02-28',
+        'precoContratual': '1234,50',
+        'cpv': '30192000-1 - Material de escritório',
+        'prazoExecucao': '30',
+        'localExecucao': 'Portugal, Porto, Vila Nova de Gaia',
+        'fundamentacao': 'NULL',
+        'ProcedimentoCentralizado': 'Não',
+        'DescrAcordoQuadro': '',
+    }
+    row.update(changes)
+    return row
+
+
+def test_nif_valido():
+    """O dígito de controlo tem de corresponder aos oito primeiros dígitos."""
+    assert nif_valido('508142156')
+    assert nif_valido('500000000')
+    assert not nif_valido('508142157')
+
+
+def test_nif_valido_formato():
+    """NIFs vazios, curtos ou com letras são inválidos."""
+    for nif in (None, '', '50814215', '5081421560', '50814215A', ' 508142156'):
+        assert not nif_valido(nif)
+
+
+def test_parse_date_formatos():
+    """Datas ISO, portuguesas e com hora resultam em DD/MM/AAAA."""
+    assert parse_date('2024-03-01') == '01/03/2024'
+    assert parse_date('01/03/2024') == '01/03/2024'
+    assert parse_date('2024-03-01 00:00:00') == '01/03/2024'
+
+
+def test_parse_date_objetos():
+    """Células de data do xlsx (date ou datetime) são aceites."""
+    assert parse_date(datetime.date(2024, 12, 31)) == '31/12/2024'
+    assert parse_date(datetime.datetime(2024, 1, 5, 10, 30)) == '05/01/2024'
+
+
+def test_parse_date_invalida():
+    """Datas impossíveis ou noutro formato lançam ValueError."""
+    for value in ('2024-02-30', '31-12-2024', 'ontem'):
+        with pytest.raises(ValueError):
+            parse_date(value)
+
+
+def test_validate_row_normaliza():
+    """Uma linha válida é convertida para os tipos e formatos da base."""
+    record = validate_row(_row())
+    assert record['IdContrato'] == 10939999
+    assert record['NIFAdjudicante'] == 508142156
+    assert record['DesignacaoAdjudicante'] == 'Unidade Local de Saúde'
+    assert record['Adjudicatarios'] == [('500000000', 'Fornecedor, Lda')]
+    assert record['DataPublicacao'] == '01/03/2024'
+    assert record['DataCelebracaoContrato'] == '28/02/2024'
+    assert record['preco'] == 1234.5
+    assert record['Cpvs'] == [('30192000-1', 'Material de escritório')]
+    assert record['PrazoExecucao'] == 30
+    assert record['Localizacoes'] == [('Portugal', 'Porto', 'Vila Nova de Gaia')]
+    assert record['Fundamentacao'] is None
+
+
+def test_validate_row_nif_estrangeiro():
+    """NIFs de adjudicatários que não têm 9 dígitos não são verificados."""
+    record = validate_row(_row(adjudicatarios='ES-B12345678 - Empresa, SL | 500000000 - Fornecedor, Lda'))
+    assert [nif for nif, _ in record['Adjudicatarios']] == ['ES-B12345678', '500000000']
+
+
+@pytest.mark.parametrize('changes, motivo', [
+    ({'idcontrato': 'abc'}, 'idcontrato inválido'),
+    ({'adjudicante': 'NULL'}, 'adjudicante em falta'),
+    ({'adjudicante': '508142157 - Entidade'}, 'NIF do adjudicante inválido'),
+    ({'adjudicatarios': '508142157 - Fornecedor'}, 'NIF do adjudicatário inválido'),
+    ({'dataPublicacao': ''}, 'data de publicação em falta'),
+    ({'dataPublicacao': '2024-13-01'}, 'data inválida'),
+    ({'precoContratual': 'mil euros'}, 'preço inválido'),
+    ({'precoContratual': '-1'}, 'preço negativo'),
+    ({'cpv': '3019200-1 - Material'}, 'código CPV inválido'),
+    ({'cpv': ''}, 'CPV em falta'),
+    ({'prazoExecucao': 'trinta'}, 'prazo de execução inválido'),
+])
+def test_validate_row_rejeita(changes, motivo):
+    """Linhas inválidas lançam ValueError com o motivo guardado na quarentena."""
+    with pytest.raises(ValueError, match=motivo):
+        validate_row(_row(**changes))
+
+
+def test_validate_row_coluna_em_falta():
+    """Uma linha sem uma coluna é rejeitada com ValueError e não com KeyError."""
+    row = _row()
+    del row['adjudicante']
+    with pytest.raises(ValueError, match='adjudicante em falta'):
+        validate_row(row)
+
+    row = _row()
+    del row['DescrAcordoQuadro']
+    assert validate_row(row)['DescrAcordoQuadro'] is None
+
+
+def test_check_columns():
+    """Um cabeçalho sem colunas obrigatórias é recusado antes da leitura."""
+    header = list(_row())
+    check_columns('extrato.tsv', header)
+    with pytest.raises(ValueError, match='DescrAcordoQuadro'):
+        check_columns('extrato.tsv', header[:-1])
+
+
+def test_split_tsv(tmp_path):
+    """Os intervalos de um tsv cobrem todas as linhas, com os números de linha do ficheiro."""
+    header = list(_row())
+    path = tmp_path / 'extrato.tsv'
+    lines = ['\t'.join(header)]
+    for i in range(7):
+        lines.append('\t'.join(_row(idcontrato=str(i)).values()))
+    path.write_text('\n'.join(lines) + '\n', encoding='utf-8')
+
+    ranges = list(split_tsv(str(path), batch_size=3))
+    assert [first_line for _, _, first_line in ranges] == [2, 5, 8]
+    rows = [row for bounds in ranges for row in read_tsv_range(str(path), header, *bounds)]
+    assert rows == list(read_rows(str(path)))
@@ -0,0 +1,33 @@
+"""
+Testes das somas acumuladas de timeseries.py.
+"""
+
+import datetime
+
+from timeseries import Series
+
+
+def _serie():
+    """Três dias a partir de 1/3/2024, com 1, 2 e 3 contratos de 10 € cada."""
+    return Series(datetime.date(2024, 3, 1), [0, 1, 3, 6], [0.0, 10.0, 30.0, 60.0])
+
+
+def test_total_intervalo():
+    """O total inclui o primeiro e o último dia."""
+    serie = _serie()
+    assert serie.total(datetime.date(2024, 3, 2), datetime.date(2024, 3, 3)) == (5, 50.0)
+    assert serie.total(datetime.date(2024, 3, 2), datetime.date(2024, 3, 2)) == (2, 20.0)
+
+
+def test_total_limites_extremos():
+    """Datas fora dos dados, até date.min e date.max, são limitadas ao intervalo."""
+    serie = _serie()
+    assert serie.total(datetime.date.min, datetime.date.max) == (6, 60.0)
+    assert serie.total(datetime.date(2024, 3, 3), datetime.date(9999, 12, 31)) == (3, 30.0)
+    assert serie.total(datetime.date(9999, 12, 31), datetime.date(9999, 12, 31)) == (0, 0.0)
+
+
+def test_buckets_fim_maximo():
+    """Os períodos terminam no último dia com dados."""
+    buckets = _serie().buckets(datetime.date(2024, 3, 1), datetime.date.max, 'dia')
+    assert [count for _, count, _ in buckets] == [1, 2, 3]
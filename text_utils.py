@@ -0,0 +1,31 @@
+"""
+Funções auxiliares de normalização de texto.
+Contratos Públicos Portugal 2024
+"""
+
+import re
+import unicodedata
+
+
+# Palavras demasiado comuns para distinguir contratos
+STOPWORDS = {
+    'a', 'ao', 'aos', 'as', 'com', 'da', 'das', 'de', 'do', 'dos', 'e', 'em',
+    'na', 'nas', 'no', 'nos', 'o', 'os', 'ou', 'para', 'pela', 'pelas', 'pelo',
+    'pelos', 'por', 'um', 'uma', 'que', 'se', 'sem', 'sob', 'sobre',
+}
+
+_TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+
+def fold_accents(text):
+    """Remove acentos e converte para minúsculas ('Saúde' -> 'saude')."""
+    if not text:
+        return ''
+    decomposed = unicodedata.normalize('NFKD', str(text))
+    return ''.join(ch for ch in decomposed if not unicodedata.combining(ch)).lower()
+
+
+def tokenize(text, min_length=3):
+    """Divide um texto normalizado em palavras, ignorando stopwords e palavras curtas."""
+    return [token for token in _TOKEN_RE.findall(fold_accents(text))
+            if len(token) >= min_length and token not in STOPWORDS]
@@ -0,0 +1,225 @@
+"""
+Séries temporais de gasto e número de contratos por somas acumuladas.
+Contratos Públicos Portugal 2024
+
+Para cada data (publicação ou celebração) e cada fatia (total, distrito,
+tipo de procedimento ou divisão CPV) guarda-se um vetor com a soma acumulada,
+dia a dia, do número de contratos e do preço. O total de qualquer intervalo
+de datas é a diferença de duas posições do vetor (O(1)), e uma série diária,
+semanal ou mensal custa O(dias) ou menos.
+
+Os vetores ficam na tabela SERIETEMPORAL (um BLOB por fatia) e são
+carregados para memória por cada processo web, sendo recarregados quando
+a tabela é reconstruída.
+
+Utilização:
+    python timeseries.py
+"""
+
+import datetime
+import logging
+import sqlite3
+import threading
+import time
+from array import array
+from collections import defaultdict
+
+import db
+
+
+FIELDS = {
+    'publicacao': 'DataPublicacao',
+    'celebracao': 'DataCelebracaoContrato',
+}
+
+# Consulta que devolve (IdContrato, valor da fatia) para cada dimensão
+DIMENSIONS = {
+    'total': "SELECT IdContrato, '' FROM CONTRATOS",
+    'distrito': "SELECT DISTINCT IdContrato, IdDistrito FROM LOCALIZACAOCONTRATOS WHERE IdDistrito IS NOT NULL",
+    'procedimento': "SELECT IdContrato, TipoProcedimento FROM CONTRATOS WHERE TipoProcedimento IS NOT NULL",
+    'cpv': "SELECT DISTINCT IdContrato, substr(CodCpv, 1, 2) FROM CONTRATOSCPV",
+}
+
+GRANULARITIES = ('dia', 'semana', 'mes')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS SERIETEMPORAL (
+    Campo      VARCHAR (20),
+    Dimensao   VARCHAR (20),
+    Valor      VARCHAR (100),
+    DataInicio DATE,
+    Contagens  BLOB,
+    Gastos     BLOB,
+    Versao     REAL,
+    PRIMARY KEY (Campo, Dimensao, Valor)
+);
+"""
+
+
+def parse_db_date(text):
+    """Converte uma data da base (DD/MM/AAAA) para datetime.date, ou None."""
+    try:
+        return datetime.datetime.strptime(str(text), '%d/%m/%Y').date()
+    except ValueError:
+        return None
+
+
+class Series:
+    """Somas acumuladas diárias de contagem e gasto de uma fatia."""
+
+    def __init__(self, start, counts, spend):
+        self.start = start
+        self.counts = counts   # counts[i] = contratos nos dias anteriores ao dia i
+        self.spend = spend
+        self.days = len(counts) - 1
+
+    @property
+    def end(self):
+        return self.start + datetime.timedelta(days=self.days - 1)
+
+    def _index(self, day):
+        """Posição no vetor acumulado do início de um dia, limitada ao intervalo."""
+        return min(max((day - self.start).days, 0), self.days)
+
+    def total(self, first, last):
+        """Contagem e gasto entre duas datas (inclusive), em tempo constante."""
+        # Limitar antes de somar um dia: fim=9999-12-31 é uma data válida no formulário
+        first, last = max(first, self.start), min(last, self.end)
+        a, b = self._index(first), self._index(last + datetime.timedelta(days=1))
+        if b <= a:
+            return 0, 0.0
+        return self.counts[b] - self.counts[a], self.spend[b] - self.spend[a]
+
+    def buckets(self, first, last, granularity):
+        """Lista de (início do período, contagem, gasto) entre duas datas."""
+        first, last = max(first, self.start), min(last, self.end)
+        result = []
+        period = _period_start(first, granularity)
+        while period <= last:
+            following = _next_period(period, granularity)
+            count, spend = self.total(max(period, first), min(following - datetime.timedelta(days=1), last))
+            result.append((period, count, spend))
+            period = following
+        return result
+
+
+def _period_start(day, granularity):
+    if granularity == 'semana':
+        return day - datetime.timedelta(days=day.weekday())
+    if granularity == 'mes':
+        return day.replace(day=1)
+    return day
+
+
+def _next_period(day, granularity):
+    if granularity == 'semana':
+        return day + datetime.timedelta(days=7)
+    if granularity == 'mes':
+        return (day.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+    return day + datetime.timedelta(days=1)
+
+
+def build(conn):
+    """Recalcula os vetores acumulados de todas as fatias."""
+    conn.executescript(SCHEMA)
+    contracts = {}
+    for id_contrato, publicacao, celebracao, preco in conn.execute(
+            "SELECT IdContrato, DataPublicacao, DataCelebracaoContrato, preco FROM CONTRATOS"):
+        contracts[id_contrato] = ({'publicacao': parse_db_date(publicacao),
+                                   'celebracao': parse_db_date(celebracao)}, preco or 0.0)
+
+    slices = {dimension: [(id_contrato, str(value)) for id_contrato, value in conn.execute(query)]
+              for dimension, query in DIMENSIONS.items()}
+
+    version = time.time()
+    rows = []
+    for field in FIELDS:
+        field_dates = [dates[field] for dates, _ in contracts.values() if dates[field]]
+        if not field_dates:
+            continue
+        start, end = min(field_dates), max(field_dates)
+        n_days = (end - start).days + 1
+
+        for dimension, members in slices.items():
+            daily = defaultdict(lambda: ([0] * n_days, [0.0] * n_days))
+            for id_contrato, value in members:
+                if id_contrato not in contracts:
+                    continue
+                dates, preco = contracts[id_contrato]
+                day = dates[field]
+                if day is None:
+                    continue
+                counts, spend = daily[value]
+                counts[(day - start).days] += 1
+                spend[(day - start).days] += preco
+
+            for value, (counts, spend) in daily.items():
+                cumulative_counts, cumulative_spend = array('q', [0]), array('d', [0.0])
+                for count, amount in zip(counts, spend):
+                    cumulative_counts.append(cumulative_counts[-1] + count)
+                    cumulative_spend.append(cumulative_spend[-1] + amount)
+                rows.append((field, dimension, value, start.isoformat(),
+                             cumulative_counts.tobytes(), cumulative_spend.tobytes(), version))
+
+    try:
+        conn.execute("DELETE FROM SERIETEMPORAL")
+        conn.executemany("INSERT INTO SERIETEMPORAL VALUES (?,?,?,?,?,?,?)", rows)
+        conn.commit()
+    except sqlite3.Error as e:
+        logging.error(f'Erro ao gravar séries temporais: {e}')
+        conn.rollback()
+        raise
+    logging.info(f'Séries temporais: {len(rows)} fatias')
+
+
+# Cache por processo, recarregada quando a versão da tabela muda
+_cache = {'version': None, 'series': {}}
+_cache_lock = threading.Lock()
+
+
+def load_series():
+    """Retorna {(campo, dimensão, valor): Series}, ou {} se ainda não construído."""
+    try:
+        version = db.execute_query("SELECT MAX(Versao) AS versao FROM SERIETEMPORAL")[0]['versao']
+    except Exception:
+        return {}
+    with _cache_lock:
+        if version != _cache['version']:
+            series = {}
+            for row in db.execute_query("SELECT * FROM SERIETEMPORAL"):
+                counts, spend = array('q'), array('d')
+                counts.frombytes(row['Contagens'])
+                spend.frombytes(row['Gastos'])
+                start = datetime.date.fromisoformat(row['DataInicio'])
+                series[(row['Campo'], row['Dimensao'], row['Valor'])] = Series(start, counts, spend)
+            _cache['series'], _cache['version'] = series, version
+        return _cache['series']
+
+
+def get_series(field, dimension='total', value=''):
+    """Retorna a Series de uma fatia, ou None se não existir."""
+    return load_series().get((field, dimension, str(value)))
+
+
+def dimension_values(dimension):
+    """Pares (valor, descrição) disponíveis numa dimensão, ordenados pela descrição."""
+    values = {value for (_, d, value) in load_series() if d == dimension}
+    labels = {}
+    try:
+        if dimension == 'distrito':
+            labels = {str(row['IdDistrito']): row['NomeDistrito']
+                      for row in db.execute_query("SELECT IdDistrito, NomeDistrito FROM DISTRITO")}
+        elif dimension == 'cpv':
+            labels = {row['CodCpv'][:2]: f"{row['CodCpv'][:2]} - {row['designacao']}"
+                      for row in db.execute_query("SELECT CodCpv, designacao FROM CPV WHERE CodCpv LIKE '__000000-_'")}
+    except Exception:
+        pass
+    return sorted(((value, labels.get(value) or value) for value in values), key=lambda item: item[1])
+
+
+if __name__ == '__main__':
+    conn = db.get_connection()
+    try:
+        build(conn)
+    finally:
+        db.close_connection(conn)